@@ -0,0 +1,225 @@
+import sys, os, io, gc, json, time, argparse, tempfile, shutil, contextlib, threading
+import subprocess as sp
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'hurricanes'))
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from read_data import HurricaneDatabase
+import animate_tracks as at
+import sonify_tracks as st
+
+# Times the load, animate and sonify hot paths on synthetic model files and
+# on the model runs in data/atl_models, and prints the results as JSON.
+#
+#   python bench.py [--storms 200 --length 40 --years 10] [--no-real] [--output results.json]
+#
+# Each result has the best wall time over --repeat runs and the peak increase
+# of resident memory (sampled, Linux only).
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+real_fixtures = ['RCP85_ATL_TCGI_CRH_PI_E20_1_short', 'RCP85_ATL_TCGI_CRH_PI_E20_1']
+
+# Parameters of generate.py
+sample_rate = 5.
+fps = 20.
+fade_inc = 0.005
+scale, shift = 0.04, 2.2
+
+def write_synthetic(filename, n_storms, track_length, years, seed=0):
+    ''' Writes a model file of n_storms random tracks, in chronological order,
+    starting on the 6 hourly grid over the given number of years. Track
+    lengths are uniform between half and one and a half times track_length. '''
+    rng = np.random.default_rng(seed)
+    steps = int(years*365.25*4)
+    starts = np.sort(rng.integers(0, steps, n_storms))
+    lengths = rng.integers(max(track_length//2, 1), track_length*3//2 + 1, n_storms)
+    t0 = pd.Timestamp('2076-01-01')
+
+    with open(filename, 'w') as f:
+        for k, (start, n) in enumerate(zip(starts, lengths)):
+            f.write('%d, %d\n' % (k, n))
+            times = t0 + pd.to_timedelta(6*(start + np.arange(n)), unit='h')
+
+            # Random walks from a genesis location
+            lat = rng.uniform(8., 25.) + np.cumsum(rng.normal(0.3, 0.3, n))
+            lon = rng.uniform(280., 340.) + np.cumsum(rng.normal(-0.4, 0.4, n))
+            wind = np.clip(25. + np.cumsum(rng.normal(1., 6., n)), 10., 180.)
+            for t, row in zip(times, zip(lat, lon, wind)):
+                f.write('%s, %s, %r, %r, %r\n' % (t.strftime('%Y%m%d'),
+                                                  t.strftime('%H%M'), *row))
+
+class NullWriter():
+    ''' Movie writer that renders every frame with the Agg canvas and drops it '''
+    def __init__(self):
+        self.frames = 0
+
+    @contextlib.contextmanager
+    def saving(self, fig, outfile, dpi):
+        yield self
+
+    def grab_frame(self, **savefig_kwargs):
+        plt.gcf().canvas.draw()
+        self.frames += 1
+
+class Projection():
+    ''' Identity map projection standing in for Basemap '''
+    def __call__(self, x, y):
+        return x, y
+
+    def plot(self, *args, **kwargs):
+        return plt.plot(*args, **kwargs)
+
+class PeakMemory():
+    ''' Samples the resident memory of the process in a background thread
+    (tracing allocations would slow the timed code down too much). peak is
+    the largest increase over the resident memory at start, in bytes, or
+    None where /proc/self/statm is not available. '''
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = None
+
+    @staticmethod
+    def rss():
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+
+    def sample(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, self.rss() - self.start)
+
+    def __enter__(self):
+        if os.path.exists('/proc/self/statm'):
+            self.start, self.peak = self.rss(), 0
+            self.done = threading.Event()
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.peak is not None:
+            self.done.set()
+            self.thread.join()
+            self.peak = max(self.peak, self.rss() - self.start)
+
+def measure(fn, setup=None, repeat=1):
+    ''' Returns best wall time (s) and peak memory increase (bytes) of
+    fn(state) over repeat calls, where state is returned by setup() (not
+    timed) '''
+    best, peak = None, None
+    for i in range(repeat):
+        state = setup() if setup is not None else None
+        gc.collect()
+        with PeakMemory() as memory:
+            start = time.perf_counter()
+            fn(state)
+            seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+        if memory.peak is not None:
+            peak = max(peak or 0, memory.peak)
+    return {'seconds': best, 'peak_bytes': peak}
+
+def loaded(filename):
+    ''' Returns a setup function loading filename (from the cache) '''
+    def setup():
+        d = HurricaneDatabase()
+        d.load_data(filename)
+        return d
+    return setup
+
+def animate_frames(filename, figsize, backend):
+    ''' Runs the animate frame loop headless; returns number of frames '''
+    plt.close('all')
+    plt.figure(figsize=figsize)
+    writer = NullWriter()
+    at.animate(filename, filename, Projection(), writer, sample_rate, fade_inc,
+               'benchmark', backend=backend)
+    return writer.frames
+
+def cold_start(filename):
+    ''' Parses the first storm of filename in a fresh interpreter (lazy
+    load), so the time includes interpreter start and all imports '''
+    code = ("import sys; sys.path.insert(0, %r)\n"
+            "import sonify_tracks\n"
+            "from read_data import HurricaneDatabase\n"
+            "d = HurricaneDatabase(lazy=True)\n"
+            "d.load_data(%r)\n"
+            "d.event_data(d.list_events()[0])\n"
+            % (os.path.join(repo_dir, 'hurricanes'), filename))
+    sp.run([sys.executable, '-c', code], check=True)
+
+def benchmarks(filename, figsize, backend):
+    ''' Returns the benchmarks of one model file as a dictionary mapping
+    name to (function, setup) '''
+    return {
+        'cold_start': (lambda state: cold_start(filename), None),
+        'load_parse': (lambda state: HurricaneDatabase().load_data(filename, cache=False),
+                       None),
+        'load_cached': (lambda d: HurricaneDatabase().load_data(filename),
+                        loaded(filename)),
+        'datetimes': (lambda d: d.datetimes(), loaded(filename)),
+        'data_range': (lambda d: d.data_range('max_wind'), loaded(filename)),
+        'animate': (lambda state: animate_frames(filename, figsize, backend), None),
+        'sonify': (lambda state: st.sonify(filename, io.StringIO(), fps, sample_rate,
+                                           'max_wind', scale, shift), None),
+        'sonify_stream': (lambda state: st.sonify_stream(filename, io.StringIO(), fps,
+                                                         sample_rate, 'max_wind',
+                                                         scale, shift), None)}
+
+def bench_fixture(filename, repeat, figsize, backend, only=None):
+    ''' Runs all benchmarks (or those named in only) on one model file.
+    Cached loads are timed after the cache has been written by a setup load. '''
+    results = {}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for name, (fn, setup) in benchmarks(filename, figsize, backend).items():
+            if only is None or name in only:
+                results[name] = measure(fn, setup, repeat)
+
+    d = loaded(filename)()
+    info = {'storms': len(d.list_events()), 'rows': int(d.offsets[-1]),
+            'timesteps': len(d.datetimes())}
+    return {'file': os.path.basename(filename), 'size': info, 'results': results}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--storms', type=int, nargs='*', default=[200],
+                        help="numbers of storms of synthetic fixtures")
+    parser.add_argument('--length', type=int, default=40,
+                        help="mean track length (6 hourly steps)")
+    parser.add_argument('--years', type=float, default=3.)
+    parser.add_argument('--no-real', action='store_true',
+                        help="skip the model runs in data/atl_models")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--figsize', type=float, nargs=2, default=[4., 4.])
+    parser.add_argument('--backend', default='collection')
+    parser.add_argument('--only', nargs='*', help="names of benchmarks to run")
+    parser.add_argument('--output', help="JSON file (default: stdout)")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fixtures = []
+        for n in args.storms:
+            filename = os.path.join(tmp_dir, 'synthetic_%d.txt' % n)
+            write_synthetic(filename, n, args.length, args.years)
+            fixtures.append(filename)
+        if not args.no_real:
+            fixtures += [os.path.join(repo_dir, 'data', 'atl_models', name + '.txt')
+                         for name in real_fixtures]
+
+        report = {'parameters': vars(args),
+                  'fixtures': [bench_fixture(f, args.repeat, args.figsize, args.backend,
+                                             args.only)
+                               for f in fixtures]}
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
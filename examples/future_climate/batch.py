@@ -0,0 +1,82 @@
+import sys, os, argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'hurricanes'))
+
+from headless import headless
+headless()
+import matplotlib.pyplot as plt
+from background import BlitWriter
+from ensemble import run_ensemble
+import pipeline as pl
+
+# Generates score, audio and movie for every model run listed in a file
+# (e.g. model_runs.txt) with a pool of workers. Each worker sets up the
+# map and bluemarble background once and reuses them for all its runs.
+# Runs whose outputs are newer than their data (and this script) are skipped.
+#
+#   python batch.py model_runs.txt [--processes N] [--force]
+
+# Parameters
+sample_rate = 5.
+fps = 20.
+fade_inc = 0.005
+scale, shift = 0.04, 2.2
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+def data_file(base_name):
+    ''' Path to the model data of a run '''
+    return os.path.join(repo_dir, 'data', 'atl_models', base_name + '.txt')
+
+def inputs(base_name):
+    ''' Files a run is generated from '''
+    return [data_file(base_name), os.path.abspath(__file__)]
+
+def outputs(base_name):
+    ''' Files generated for a run '''
+    return [base_name + '.sco', base_name + '.wav', base_name + 'sound.mp4']
+
+def setup():
+    ''' Builds figure, map projection and background once per worker '''
+    from mpl_toolkits.basemap import Basemap
+    plt.rcParams['axes.facecolor']='black'
+    plt.rcParams['savefig.facecolor']='black'
+
+    fig = plt.figure()
+    fig.set_size_inches(28.2, 32.4, forward=True)
+    fig.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=None, hspace=None)
+
+    print("loading basemap...")
+    m = Basemap(llcrnrlon=-120.,llcrnrlat=-7.,urcrnrlon=-7.0,urcrnrlat=52.,
+                projection='lcc',lat_1=1.,lat_2=1.,lon_0=-1.,
+                resolution ='l')
+
+    print("loading blue marble...")
+    m.bluemarble()
+    return fig, m
+
+def generate(base_name, shared):
+    ''' Writes score, audio, movie and movie with sound for one run '''
+    fig, m = shared
+    data = data_file(base_name)
+    plt.figure(fig.number)
+
+    # Animate tracks over the background rendered by this worker, while the
+    # score is written and rendered by CMIX
+    writer = BlitWriter(fps=20, bitrate=100000)
+    pl.generate(data, data, m, writer, base_name, fps, sample_rate, fade_inc,
+                'max_wind', scale, shift,
+                animate_kwargs={'backend': 'collection', 'blit_background': True})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('runs', help="file listing one model run per line")
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--force', action='store_true',
+                        help="regenerate runs that are up to date")
+    args = parser.parse_args()
+
+    with open(args.runs) as f:
+        runs = [l.strip() for l in f if l.strip()]
+
+    run_ensemble(runs, generate, inputs, outputs, setup, args.processes, args.force)
@@ -1,4 +1 @@
-while read p; do
-  echo "$p"
-  python test.py "$p"
-done <model_runs.txt
\ No newline at end of file
+python batch.py model_runs.txt "$@"
@@ -1,11 +1,138 @@
 from read_data import HurricaneDatabase
 from cyclone import Cyclone
+from track_collection import TrackCollection
+from background import render_background, blit, prepare_canvas
+from telemetry import NullTelemetry
+from checkpoint import RenderCheckpoint
 import matplotlib.pyplot as plt
+import multiprocessing as mp
+from collections import deque
 import numpy as np
+import pandas as pd
 import os
+import hashlib
 
-def animate(data, data_rcp, figure, writer, sample_rate, fade_inc, base_name):
-    ''' Plots all tracks in dataset '''
+class TrackAnimator():
+    ''' Holds the cyclone state of the track animation. The state after step
+    k only depends on k, so it can be rebuilt for any window of time.
+    events (positions in d.list_events(), e.g. from d.query) restricts the
+    animation to those storms. '''
+    def __init__(self, d, wind_range, figure, fade_inc, backend='lines',
+                 events=None):
+        self.figure = figure
+        self.fade_inc = fade_inc
+        self.backend = backend
+
+        # Get events and datetime range
+        self.date_times = d.datetimes()
+
+        # Events starting and ending at each timestep
+        self.starts, self.ends = d.interval_index()
+        if events is not None:
+            selected = set(np.asarray(events).tolist())
+            self.starts, self.ends = [{k: [e for e in es if e in selected]
+                                       for k, es in steps.items()}
+                                      for steps in (self.starts, self.ends)]
+
+        # Current active cyclones (by event position) and fading inactive cyclones
+        self.active_cyclones, self.inactive_cyclones = {}, []
+
+        # Container of Cyclone objects (by event position)
+        IDs = d.list_events()
+        positions = range(len(IDs)) if events is None else np.asarray(events).tolist()
+        self.objs = {e: Cyclone(d.event_data(IDs[e]), IDs[e], wind_range, figure)
+                     for e in positions}
+
+        # Shared collection with room for every segment of every cyclone
+        self.collection = None
+        if backend == 'collection':
+            segments = np.maximum(np.diff(d.offsets) - 1, 0)
+            capacity = int(segments[list(self.objs)].sum())
+            self.collection = TrackCollection(plt.gca(), capacity)
+
+        # Artists drawn on top of the background in blit mode
+        self.track_artists = []
+        if self.collection is not None:
+            self.track_artists.append(self.collection.collection)
+
+        # Initialize empty annotation
+        self.date_time = plt.annotate('', xy=(0, 1), xycoords='axes fraction')
+
+        # Next step to be applied
+        self.k = 0
+
+    def advance(self, k):
+        ''' Applies cyclone updates for all timesteps up to and including k.
+        Each cyclone's track additions and fade decrements over these steps
+        are applied in one batch. '''
+        figure = self.figure
+        first = dict.fromkeys(self.active_cyclones, self.k)
+        updates, fades = {}, [(c, k + 1 - self.k) for c in self.inactive_cyclones]
+
+        for j in range(self.k, k + 1):
+            # Move cyclones that ended before this step to inactive
+            for e in self.ends.get(j, []):
+                if e in self.active_cyclones:
+                    updates[e] = j - first.pop(e)
+                    fades.append((self.active_cyclones.pop(e), k + 1 - j))
+
+            # Add new cyclones
+            for e in self.starts.get(j, []):
+                if self.collection is None:
+                    self.objs[e].set_figure(figure)
+                    self.track_artists += self.objs[e].tracks
+                else:
+                    self.objs[e].set_collection(self.collection)
+                self.objs[e].initialize_cyclone(self.date_times[j], figure)
+                self.active_cyclones[e] = self.objs[e]
+                first[e] = j
+
+        # Update locations
+        for e, j in first.items():
+            updates[e] = k + 1 - j
+        for e, steps in updates.items():
+            self.objs[e].update_track(self.date_times[k], figure, steps)
+
+        # Fade tracks for inactive cyclones, dropping those whose fade stopped
+        self.inactive_cyclones = [c for c, steps in fades
+                                  if c.remove_inactive(self.fade_inc, figure, steps)]
+
+        self.k = k + 1
+
+    def seek(self, k):
+        ''' Applies all steps before k (k must not be behind current step) '''
+        if k > self.k:
+            self.advance(k - 1)
+
+    def annotate(self, k):
+        ''' Sets date annotation for timestep k '''
+        # Extract date for annotation
+        date = str(self.date_times[k]).split(' ')[0]
+
+        # Update datetime annotation
+        self.date_time.remove()
+        self.date_time = plt.annotate('{dt}'.format(dt=date), xy=(0.05, 0.05),
+                                      xycoords='axes fraction', fontsize=160,
+                                      color='whitesmoke')
+                                      # 180 fontsize
+
+        # Push collection colors before drawing
+        if self.collection is not None:
+            self.collection.update()
+
+    def artists(self):
+        ''' Returns artists drawn over the background '''
+        return self.track_artists + [self.date_time]
+
+    def remove(self):
+        ''' Removes all artists of the animation from the figure '''
+        for artist in self.artists():
+            artist.remove()
+
+def load_animation_data(data, data_rcp, resample=None):
+    ''' Loads dataset and returns it with the wind range over both datasets.
+    If resample is given (e.g. '30min'), the dataset is resampled to that
+    step (see HurricaneDatabase.resample). '''
     # Read in data
     print("Loading data...")
     d = HurricaneDatabase()
@@ -17,67 +144,251 @@ def animate(data, data_rcp, figure, writer, sample_rate, fade_inc, base_name):
     # Plot storm frequency
     #d.plot_annual_frequency(base_name)
 
-    # Find range for max wind speed
-    wind_range_rcp = list(d_rcp.data_range("max_wind"))
-    wind_range = list(d.data_range("max_wind"))
+    # Find range for max wind speed over both datasets
+    wind_range = list(HurricaneDatabase.merged_range([d, d_rcp], "max_wind"))
 
-    #print(wind_range)
-    min_wind, max_wind = wind_range[0], wind_range[1]
-    if wind_range_rcp[1] > max_wind:
-        wind_range[1] = wind_range_rcp[1]
-    if wind_range_rcp[0] < min_wind:
-        wind_range[0] = wind_range_rcp[0]
+    if resample is not None:
+        d = d.resample(resample)
 
+    return d, wind_range
 
-    # Get events and datetime range
-    date_times = d.datetimes()
+def frame_steps(d, sample_rate):
+    ''' Returns timesteps of d per frame for sample_rate 6 hourly steps per
+    frame (these differ if d is resampled) '''
+    substeps = pd.Timedelta(hours=6)//d.step
+    if substeps == 1:
+        return sample_rate
+    steps = sample_rate*substeps
+    if steps < 1 or steps != round(steps):
+        raise ValueError("sample_rate %g is not a whole number of %s steps"
+                         % (sample_rate, d.step))
+    return int(round(steps))
 
-    # Array contains acurrent active/inactive cyclones
-    active_cyclones, inactive_cyclones = [], []
+def animate(data, data_rcp, figure, writer, sample_rate, fade_inc, base_name,
+            backend='lines', blit_background=False, draw_background=None,
+            background_cache=None, loaded=None, telemetry=None, region=None,
+            window=None, resample=None, checkpoint_every=None, resume=False,
+            ffmpeg='ffmpeg'):
+    ''' Plots all tracks in dataset. With backend='lines' each track segment
+    is its own Line2D; with backend='collection' all segments are drawn by a
+    single TrackCollection.
+    If blit_background is set, the static layers (drawn by draw_background,
+    e.g. the bluemarble image) are rasterized once and cached (on disk in
+    background_cache if given). Each frame then only draws tracks and
+    annotation on a copy of that raster, which is written directly if the
+    writer has write_buffer (frame_pipe.RawVideoWriter, background.BlitWriter).
+    frame_pipe.RawVideoWriter renders frames with the Agg canvas and pipes
+    them to ffmpeg without savefig.
+    loaded is the (database, wind range) pair of load_animation_data, if the
+    data has already been loaded. telemetry (a telemetry.Telemetry) times the
+    update, draw, grab and encode stages of each frame (grab_frame when the
+    writer has no write_buffer and draws the frame itself) and counts
+    active and fading storms.
+    region = (lat_min, lat_max, lon_min, lon_max) and window = (start, end)
+    restrict the animation to the storms passing through region within
+    window (see HurricaneDatabase.query); with a window only its timesteps
+    are rendered.
+    resample (e.g. '30min') interpolates the tracks to that step, so each
+    frame draws the motion since the last one in finer segments; sample_rate
+    stays in 6 hourly steps and may then be fractional (e.g. 0.5 for a
+    frame every 3 hours).
+    With checkpoint_every, the movie is written in segments of that many
+    frames and the loop state is saved after each one (see
+    checkpoint.RenderCheckpoint); with resume, rendering continues after
+    the last saved segment of an interrupted render. The segments are
+    joined into base_name + '.mp4' with ffmpeg at the end. '''
+    telemetry = NullTelemetry() if telemetry is None else telemetry
+    if loaded is None:
+        loaded = load_animation_data(data, data_rcp, resample)
+    elif resample is not None:
+        loaded = (loaded[0].resample(resample), loaded[1])
+    d, wind_range = loaded
+    sample_rate = frame_steps(d, sample_rate)
+    events = None if region is None and window is None else d.query(region, window)
+    animator = TrackAnimator(d, wind_range, figure, fade_inc, backend, events)
+    first, stop = d.window_steps(window)
 
-    # Container of Cyclone objects
-    objs = [Cyclone(d.event_data(e), e, wind_range) for e in d.list_events()]
+    # Timesteps of emitted frames (only their state is computed)
+    steps = [k for k in range(first, stop) if k % sample_rate == 0]
+    animator.seek(first)
 
-    # Initialize empty annotation
-    date_time = plt.annotate('', xy=(0, 1), xycoords='axes fraction')
+    checkpoint, done = None, 0
+    if checkpoint_every is not None:
+        # Selected storms are identified by a hash of their IDs; the wind
+        # range sets the track colors
+        IDs = d.list_events()
+        selected = None if events is None else hashlib.sha1(
+            '\n'.join(IDs[e] for e in np.asarray(events).tolist()).encode()).hexdigest()
+        params = {'data': os.path.abspath(data), 'data_rcp': os.path.abspath(data_rcp),
+                  'wind_range': [float(w) for w in wind_range], 'first': first,
+                  'stop': stop, 'step': str(d.step), 'sample_rate': sample_rate,
+                  'fade_inc': fade_inc, 'backend': backend, 'events': selected}
+        checkpoint = RenderCheckpoint(base_name, checkpoint_every, params, ffmpeg)
+        if resume:
+            done = checkpoint.resume(animator, steps)
 
     # Loop through time and add tracks
     print("Animating tracks...")
-    with writer.saving(plt.gcf(), base_name + '.mp4', 100):
-        for k, dt in enumerate(date_times):
-            print(dt)
-
-            # Extract date for annotation
-            date = str(dt).split(' ')[0]
-
-            # Update datetime annotation
-            date_time.remove()
-            date_time = plt.annotate('{dt}'.format(dt=date), xy=(0.05, 0.05),
-                                     xycoords='axes fraction', fontsize=160,
-                                     color='whitesmoke')
-                                     # 180 fontsize
-            # Remove tracks for inactive cyclones
-            inactive_current = [c for c in active_cyclones if c.datetime()[-1] < dt]
-            inactive_cyclones += inactive_current
-            inactive_cyclones = [c for c in inactive_cyclones if c.__dict__['fade'] >= 0.0]
-
-            for cyclone in inactive_cyclones:
-                cyclone.remove_inactive(fade_inc,figure)
-
-            # Remove old cyclones
-            active_cyclones = [c for c in active_cyclones if c.datetime()[-1] >= dt]
+    fig, dpi = plt.gcf(), 100
 
-            # Add new cyclones
-            for obj in objs:
-                if (obj.datetime()[0] == dt):
-                    obj.set_figure(figure)
-                    obj.initialize_cyclone(dt,figure)
-                    active_cyclones.append(obj)
+    def render(ks):
+        ''' Renders the frames of timesteps ks to the open writer '''
+        raw = hasattr(writer, 'write_buffer')
+        if blit_background or raw:
+            prepare_canvas(fig, dpi)
+        if blit_background:
+            # Tracks already drawn (after a seek or resume) are not static
+            artists = animator.artists()
+            visible = [artist.get_visible() for artist in artists]
+            for artist in artists:
+                artist.set_visible(False)
+            background = render_background(fig, figure, draw_background,
+                                           background_cache)
+            for artist, shown in zip(artists, visible):
+                artist.set_visible(shown)
 
-            # Update locations
-            for cyclone in active_cyclones:
-                cyclone.update_track(dt,figure)
+        for k in ks:
+            telemetry.start_step(animator.date_times[k])
+            animator.advance(k)
 
             # Add frame to animation
-            if((k % sample_rate == 0)):
+            animator.annotate(k)
+            telemetry.mark('update')
+            if blit_background:
+                blit(fig, background, animator.artists())
+                telemetry.mark('draw')
+            elif raw:
+                fig.canvas.draw()
+                telemetry.mark('draw')
+            if raw:
+                buffer = fig.canvas.get_renderer().buffer_rgba()
+                telemetry.mark('grab')
+                writer.write_buffer(buffer)
+                telemetry.mark('encode')
+            else:
                 writer.grab_frame()
+                telemetry.mark('grab_frame')
+            telemetry.end_step(active=len(animator.active_cyclones),
+                               fading=len(animator.inactive_cyclones))
+
+    telemetry.start(len(steps) - done)
+    if checkpoint is None:
+        with writer.saving(fig, base_name + '.mp4', dpi):
+            render(steps)
+    else:
+        for frame in range(done, len(steps), checkpoint.every):
+            segment = steps[frame:frame + checkpoint.every]
+            with writer.saving(fig, checkpoint.segment(frame//checkpoint.every), dpi):
+                render(segment)
+            checkpoint.save(animator, frame + len(segment))
+        checkpoint.concat(base_name + '.mp4', -(-len(steps)//checkpoint.every))
+    telemetry.finish()
+
+    # Leave the figure as it was (e.g. to animate another run on it)
+    animator.remove()
+
+# Per-process state of parallel rendering workers
+worker_state = {}
+
+def init_worker(data, data_rcp, make_figure, fade_inc, size_inches, dpi,
+                blit_background, draw_background, background_cache, events=None,
+                resample=None):
+    ''' Builds figure, map, cyclone state and background in a worker '''
+    fig, figure = make_figure()
+    fig.set_size_inches(size_inches)
+    prepare_canvas(fig, dpi)
+
+    background = None
+    if blit_background:
+        background = render_background(fig, figure, draw_background,
+                                       background_cache)
+    elif draw_background is not None:
+        draw_background(figure)
+
+    d, wind_range = load_animation_data(data, data_rcp, resample)
+    worker_state.update(fig=fig, figure=figure, d=d, wind_range=wind_range,
+                        fade_inc=fade_inc, background=background, events=events,
+                        animator=TrackAnimator(d, wind_range, figure, fade_inc,
+                                               'collection', events))
+
+def render_chunk(chunk):
+    ''' Renders the emitted frames of timesteps start:stop in a worker.
+    Returns list of raw RGBA frame buffers. '''
+    start, stop, sample_rate = chunk
+    fig, background = worker_state['fig'], worker_state['background']
+
+    # Rebuild cyclone state at start of chunk (workers take chunks in order,
+    # so this normally only moves forward)
+    animator = worker_state['animator']
+    if animator.k > start:
+        animator.remove()
+        animator = TrackAnimator(worker_state['d'], worker_state['wind_range'],
+                                 worker_state['figure'], worker_state['fade_inc'],
+                                 'collection', worker_state['events'])
+        worker_state['animator'] = animator
+    animator.seek(start)
+
+    frames = []
+    for k in range(start, stop):
+        if((k % sample_rate == 0)):
+            animator.advance(k)
+            animator.annotate(k)
+            if background is not None:
+                blit(fig, background, animator.artists())
+            else:
+                fig.canvas.draw()
+            frames.append(bytes(fig.canvas.get_renderer().buffer_rgba()))
+
+    return frames
+
+def animate_parallel(data, data_rcp, make_figure, writer, sample_rate, fade_inc,
+                     base_name, processes=None, chunk_frames=20,
+                     blit_background=False, draw_background=None,
+                     background_cache=None, region=None, window=None,
+                     resample=None):
+    ''' Plots all tracks in dataset, rendering frames in a process pool.
+    The timesteps are split into chunks of chunk_frames emitted frames; each
+    worker rebuilds the cyclone state at the start of a chunk and returns the
+    raw frames, which are written in order by a single writer. make_figure()
+    must be a picklable function returning (fig, map), writer must accept raw
+    buffers (frame_pipe.RawVideoWriter, background.BlitWriter). Tracks use
+    the collection backend. region, window and resample are as in animate.
+    At most 2*processes chunks are rendered or waiting to be written at any
+    time, so memory stays bounded when the workers outpace the encoder. '''
+    d = HurricaneDatabase()
+    d.load_data(data)
+    if resample is not None:
+        d = d.resample(resample)
+    sample_rate = frame_steps(d, sample_rate)
+    events = None if region is None and window is None else d.query(region, window)
+    first, stop = d.window_steps(window)
+
+    # Split timesteps into chunks
+    chunk_size = max(int(round(sample_rate*chunk_frames)), 1)
+    chunks = [(start, min(start + chunk_size, stop), sample_rate)
+              for start in range(first, stop, chunk_size)]
+
+    # The parent figure only sets the movie size
+    fig, figure = make_figure()
+    dpi = 100
+
+    print("Animating tracks...")
+    with writer.saving(fig, base_name + '.mp4', dpi):
+        initargs = (data, data_rcp, make_figure, fade_inc, fig.get_size_inches(),
+                    dpi, blit_background, draw_background, background_cache, events,
+                    resample)
+        processes = processes or os.cpu_count()
+        with mp.Pool(processes, initializer=init_worker, initargs=initargs) as pool:
+            # Submit a new chunk only once an earlier one has been written
+            pending = deque()
+            for chunk in chunks:
+                if len(pending) >= 2*processes:
+                    write_frames(writer, pending.popleft().get())
+                pending.append(pool.apply_async(render_chunk, (chunk,)))
+            while pending:
+                write_frames(writer, pending.popleft().get())
+
+def write_frames(writer, frames):
+    ''' Writes raw frame buffers in order, dropping each once written '''
+    while frames:
+        writer.write_buffer(frames.pop(0))
@@ -0,0 +1,76 @@
+import os
+import hashlib
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.animation import FFMpegWriter
+
+# Backgrounds rendered in this process, keyed by background_key()
+backgrounds = {}
+
+def background_key(fig, figure, draw_background=None):
+    ''' Returns key identifying a rendered background by map projection
+    parameters, figure size, resolution and the function drawing it '''
+    params = [sorted(getattr(figure, 'projparams', {}).items())]
+    params += [getattr(figure, attr, None) for attr in
+               ['llcrnrlon', 'llcrnrlat', 'urcrnrlon', 'urcrnrlat', 'resolution']]
+    params += [tuple(fig.get_size_inches()), fig.dpi, fig.get_facecolor(),
+               getattr(draw_background, '__qualname__', None)]
+    return hashlib.sha1(repr(params).encode()).hexdigest()
+
+def prepare_canvas(fig, dpi):
+    ''' Renders the canvas at movie resolution and background color, as
+    savefig would '''
+    fig.set_dpi(dpi)
+    if plt.rcParams['savefig.facecolor'] != 'auto':
+        fig.set_facecolor(plt.rcParams['savefig.facecolor'])
+
+def render_background(fig, figure, draw_background=None, cache_dir=None):
+    ''' Returns RGBA array of the static layers of the figure (e.g. the
+    bluemarble image). It is drawn once and cached in memory, and on disk if
+    cache_dir is set. draw_background(figure) is only called on a cache miss;
+    if it is None, whatever is already drawn on the figure is used. '''
+    key = background_key(fig, figure, draw_background)
+    if key in backgrounds:
+        return backgrounds[key]
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, key + '.npy')
+
+    if path is not None and os.path.exists(path):
+        # Set axes limits and aspect as drawing the background would
+        if hasattr(figure, 'set_axes_limits'):
+            figure.set_axes_limits(ax=fig.gca())
+        for ax in fig.axes:
+            ax.apply_aspect()
+        background = np.load(path)
+    else:
+        if draw_background is not None:
+            draw_background(figure)
+        fig.canvas.draw()
+        background = np.array(fig.canvas.buffer_rgba())
+
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(path, background)
+
+    backgrounds[key] = background
+    return background
+
+def blit(fig, background, artists):
+    ''' Copies background into the canvas buffer and draws artists on top '''
+    renderer = fig.canvas.get_renderer()
+    np.asarray(renderer.buffer_rgba())[...] = background
+    for artist in artists:
+        artist.draw(renderer)
+
+class BlitWriter(FFMpegWriter):
+    ''' FFMpegWriter that writes the canvas buffer left by blit() as the next
+    frame, instead of redrawing the whole figure with savefig '''
+    def grab_frame(self, **savefig_kwargs):
+        ''' Writes current canvas buffer to ffmpeg '''
+        self.write_buffer(self.fig.canvas.get_renderer().buffer_rgba())
+
+    def write_buffer(self, buffer):
+        ''' Writes a raw RGBA frame of the movie size to ffmpeg '''
+        self._proc.stdin.write(buffer)
@@ -0,0 +1,92 @@
+import os
+import json
+import shutil
+import subprocess as sp
+
+class RenderCheckpoint():
+    ''' Splits a long render into movie segments of `every` frames, written
+    to the directory base_name + '_segments'. After each segment is closed,
+    the loop state (frames done and the storms' active/fading state, fade
+    levels and drawn points) is saved to checkpoint.json there, so an
+    interrupted render can resume after the last complete segment. When all
+    frames are done the segments are joined with ffmpeg's concat demuxer
+    (without re-encoding) and removed. '''
+    def __init__(self, base_name, every, params, ffmpeg='ffmpeg'):
+        self.base_name = base_name
+        self.every = int(every)
+        self.params = dict(params, every=self.every)
+        self.ffmpeg = ffmpeg
+        self.directory = base_name + '_segments'
+        self.path = os.path.join(self.directory, 'checkpoint.json')
+
+    def segment(self, n):
+        ''' Returns file name of the n-th segment (creating the directory) '''
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, 'segment_%05d.mp4' % n)
+
+    @staticmethod
+    def animator_state(animator):
+        ''' Returns the state of a TrackAnimator as a JSON-able dictionary '''
+        return {'step': animator.k,
+                'active': sorted(c.ID for c in animator.active_cyclones.values()),
+                'fading': sorted([c.ID, c.fade] for c in animator.inactive_cyclones),
+                'cursors': {c.ID: c.track.cursor for c in animator.objs.values()
+                            if c.track is not None and c.track.cursor > 0}}
+
+    def save(self, animator, frames):
+        ''' Records that the first `frames` frames are in closed segments '''
+        state = {'params': self.params, 'frames': frames,
+                 'segments': (frames + self.every - 1)//self.every,
+                 'state': self.animator_state(animator)}
+
+        # Replace the checkpoint atomically, so a crash leaves the last one
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def load(self):
+        ''' Returns the saved checkpoint, or None if there is none '''
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            checkpoint = json.load(f)
+        if checkpoint['params'] != json.loads(json.dumps(self.params)):
+            raise ValueError("Checkpoint " + self.path + " was written with other "
+                             "render parameters; remove it to start over")
+        return checkpoint
+
+    def resume(self, animator, steps):
+        ''' Moves animator to the state after the last checkpointed frame
+        (steps are the timesteps of all frames). Returns the number of frames
+        already rendered. '''
+        checkpoint = self.load()
+        if checkpoint is None or checkpoint['frames'] == 0:
+            return 0
+
+        frames = checkpoint['frames']
+        missing = [self.segment(n) for n in range(checkpoint['segments'])
+                   if not os.path.exists(self.segment(n))]
+        if missing:
+            raise RuntimeError("Missing segments of checkpoint: " + ', '.join(missing))
+
+        # The state after a step is rebuilt by replaying up to it, and must
+        # match what was saved
+        animator.advance(steps[frames - 1])
+        if self.animator_state(animator) != checkpoint['state']:
+            raise RuntimeError("Rebuilt animation state does not match checkpoint "
+                               + self.path)
+
+        print("Resuming after frame %d of %d" % (frames, len(steps)))
+        return frames
+
+    def concat(self, outfile, n_segments):
+        ''' Joins segments into outfile and removes the segment directory '''
+        listing = os.path.join(self.directory, 'segments.txt')
+        with open(listing, 'w') as f:
+            for n in range(n_segments):
+                f.write("file '%s'\n" % os.path.basename(self.segment(n)))
+
+        sp.run([self.ffmpeg, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                '-i', listing, '-c', 'copy', outfile], check=True)
+        shutil.rmtree(self.directory)
@@ -1,18 +1,55 @@
 from read_data import HurricaneDatabase
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy import interpolate as interp
-import matplotlib as mpl
+
+# Colormap lookup tables and fade schedules, shared by all cyclones
+color_tables = {}
+fade_schedules = {}
+
+def color_table(name='jet'):
+    ''' Returns RGBA lookup table of colormap name (cached). Its last row is
+    the colormap's color for NaN. '''
+    if name not in color_tables:
+        # Only rendering needs matplotlib, so sonification does not import it
+        import matplotlib.pyplot as plt
+        cmap = plt.get_cmap(name)
+        color_tables[name] = np.vstack((cmap(np.arange(cmap.N)), cmap(np.nan)))
+    return color_tables[name]
+
+def fade_schedule(fade_inc):
+    ''' Returns the fade levels of an inactive cyclone (cached): fade starts
+    at 1 and drops by fade_inc per step, stopping at the first level at or
+    below 0.1 '''
+    if fade_inc <= 0.:
+        raise ValueError("fade_inc must be positive")
+    if fade_inc not in fade_schedules:
+        fades = [1.0]
+        while fades[-1] > 0.1:
+            fades.append(fades[-1] - fade_inc)
+        fade_schedules[fade_inc] = np.asarray(fades)
+    return fade_schedules[fade_inc]
+
+class Track():
+    ''' Projected positions and colors of a cyclone track, computed for all
+    timesteps at once. The cursor is the number of points drawn so far. When
+    drawn in a TrackCollection, base is the first segment reserved for the
+    track and alpha its current alpha. '''
+    __slots__ = ('x', 'y', 'colors', 'cursor', 'base', 'alpha')
+
+    def __init__(self, x, y, colors):
+        self.x = x
+        self.y = y
+        self.colors = colors
+        self.cursor = 0
+        self.base = 0
+        self.alpha = 1.0
 
 class Cyclone():
     def __init__(self, df, ID, wind_range=None, figure=None, mNotes=None):
         self.df = df
         self.ID = ID
         self.mNotes = mNotes
-        self.current_index = 0
         self.fade = 1.0
-        self.lats = []
-        self.longs = []
+        self.fade_step = 0
 
         self.catastrophic = False
         if float(df['max_wind'].max()) > 137.0:
@@ -21,8 +58,13 @@ class Cyclone():
         if wind_range is not None:
             self.wind_range = wind_range
 
+        # Precompute projected track (requires map and wind range)
+        self.track = None
+        if figure is not None and wind_range is not None:
+            self.track = self.project_track(figure)
 
         self.tracks = None
+        self.collection = None
         self.layer_thresholds = {'34.0':0.9, '64.0':0.8, '83.0':0.7,\
                                  '96.0': 0.6, '113.0':0.5, '137.0':0.4}
 
@@ -49,95 +91,125 @@ class Cyclone():
         min_wind, max_wind = self.wind_range[0], self.wind_range[1]
         return (current_wind - min_wind)/(max_wind - min_wind)
 
-    def update_track(self, dt, figure):
-        ''' Updates path location and color for cyclone at time t '''
-        # Set initial latitude/longitude
-        if(len(self.lats) == 0):
-            self.lats.append(self.df['latitude'][dt])
-            self.longs.append(self.df['longitude'][dt])
-            self.current_index += 1
+    def project_track(self, figure):
+        ''' Projects all points through the map and looks up all colors
+        (according to max windspeed) in the shared colormap table '''
+        x, y = figure(np.asarray(self.df['longitude']), np.asarray(self.df['latitude']))
+
+        # Quantize as the colormap would (out of range values get the end colors)
+        table = color_table()
+        n = len(table) - 1
+        scaled = self.color_scale(np.asarray(self.df['max_wind'], dtype=float))*n
+        index = np.full(len(scaled), n)
+        valid = ~np.isnan(scaled)
+        index[valid] = np.clip(scaled[valid], 0, n - 1).astype(int)
+        return Track(np.asarray(x), np.asarray(y), table[index])
+
+    def update_track(self, dt, figure, steps=1):
+        ''' Updates path location and color for cyclone at time t. With
+        steps > 1, applies that many consecutive updates at once. '''
+        track = self.track
+        start = track.cursor
+        stop = min(start + steps, len(track.x))
+
+        # The first point only sets the initial location
+        if self.collection is not None:
+            self.collection.set_segments(track, start, stop)
 
         else:
-            # Update latitude/longitudes
-            lats_prev, longs_prev = self.lats[-1], self.longs[-1]
-            self.lats.append(self.df['latitude'][dt])
-            self.longs.append(self.df['longitude'][dt])
-            lats_new, longs_new = self.df['latitude'][dt], self.df['longitude'][dt]
-
-            # Uodate location in plot
-            self.tracks[self.current_index].set_data(figure([longs_prev,\
-                                            longs_new], [lats_prev, lats_new]))
+            for i in range(max(start, 1), stop):
+                # Update location in plot
+                self.tracks[i].set_data(track.x[i - 1:i + 1], track.y[i - 1:i + 1])
 
-            # Set new color (according to max windpseed)
-            col_index = self.color_scale(self.df['max_wind'][dt])
-            self.tracks[self.current_index].set_color(plt.cm.jet(col_index))
+                # Set new color (according to max windspeed)
+                self.tracks[i].set_color(track.colors[i])
 
-            # Not sure about this
-            self.tracks[self.current_index].set_linewidth(9.)
+                # Not sure about this
+                self.tracks[i].set_linewidth(9.)
 
-            self.current_index += 1
+        track.cursor += steps
 
     def set_figure(self, figure):
         #self.figure = figure
         self.tracks = [(figure.plot([], [], alpha=self.fade))[0] for k in range(len(self.df.index))]
+        if self.track is None:
+            self.track = self.project_track(figure)
+
+    def set_collection(self, collection):
+        ''' Draws tracks as segments of a shared TrackCollection instead of
+        one line per timestep '''
+        self.collection = collection
+        collection.add(self.track)
+        collection.set_alpha(self.track, self.fade)
 
     def initialize_cyclone(self, t, figure):
-        ''' Sets initial location/radius for cyclone '''
-        # Initial location and color
-        x, y = figure(self.df['longitude'][t], self.df['latitude'][t])
-        col_index = self.color_scale(self.df['max_wind'][t])
+        ''' Sets initial location for cyclone '''
+        self.track.cursor = 0
 
-    def remove_inactive(self, fade_inc, figure):
+    def remove_inactive(self, fade_inc, figure, steps=1):
         ''' Plots progressively faded final state of inactive cyclone.
-        The fade period is set by the fade_inc parameter. '''
+        The fade period is set by the fade_inc parameter. With steps > 1,
+        applies that many consecutive fade steps at once. Returns False once
+        the fade has stopped, after which further calls change nothing. '''
+        # Position in the fade schedule after the steps of this call. The
+        # last level is at or below 0.1, where the fade stops.
+        fades = fade_schedule(fade_inc)
+        last = len(fades) - 1
+        if steps < 1:
+            return True
+        if fades[self.fade_step] < 0.0:
+            # Negative fades are dropped before fading
+            return False
+
+        n = min(steps, last - self.fade_step)
+        self.fade_step += n
+        self.fade = fades[self.fade_step]
+        fading = n == steps
+
+        # Alpha is the level before the last decrement (or the final level,
+        # unless it is negative)
+        alpha = fades[self.fade_step - 1] if fading or self.fade < 0.0 else self.fade
+
+        # Remove tracks if alpha falls below threshold
+        cleared = self.fade_step == last and self.fade < 1.e-2
 
         # Fade tracks
-        for i in range(len(self.tracks)):
-            (self.tracks)[i].set_alpha(self.fade)
+        if self.collection is not None:
+            self.collection.set_alpha(self.track, alpha)
+        else:
+            for i in range(len(self.tracks)):
+                (self.tracks)[i].set_alpha(alpha)
 
         #self.date_time.set_alpha(self.fade)
-        #if not self.catastrophic:
-        if self.fade > 0.1:
-            self.fade -= fade_inc
-
-        # Remove tracks if alpha falls below threshold
-        if(self.fade < 1.e-2):
-            self.lats, self.longs = [], []
+        if cleared and self.collection is not None:
+            self.collection.clear(self.track)
+        elif cleared:
             for i in range(len(self.tracks)):
-                (self.tracks)[i].set_data(figure(self.longs, self.lats))
+                (self.tracks)[i].set_data([], [])
+
+        return fading
 
     def layer_score_data(self, times, key, field):
         ''' Obtain times and field data for when field exceeds threshold.
         These times may form disjoint intervals '''
-        layer_on, i = False, 0
-        start_times, end_times, layer_notes = [], [], []
-        while(i < len(times)):
-            if(self.df[field][i] >= float(key)):
-                layer_on = True
-                start_times.append(times[i])
-                layer_notes_current = []
-                while(layer_on == True):
-                    if(self.df[field][i] < float(key)):
-                        if(len(layer_notes_current) != 1):
-                            # Exclude cases w
-                            end_times.append(times[i])
-                            layer_notes.append(layer_notes_current)
-                        else:
-                            start_times = start_times[:-1]
-                        layer_on = False
-                    else:
-                        layer_notes_current.append(self.df[field][i])
-                        if(i == len(times) - 1):
-                            end_times.append(times[i])
-                            layer_notes.append(layer_notes_current)
-                            break
-                        i += 1
-                if(i == len(times) - 1):
-                    break
-            else:
-                i += 1
-
-        return start_times, end_times, layer_notes
+        return self.layer_runs(times, field, [key])[key]
+
+    def layer_runs(self, times, field, keys=None):
+        ''' Obtain start times, end times and field data of the intervals in
+        which field exceeds each threshold key (all layer thresholds by
+        default). All keys are computed in one pass. '''
+        keys = list(self.layer_thresholds) if keys is None else keys
+        values = np.asarray(self.df[field])[:len(times)]
+        runs = HurricaneDatabase.threshold_runs(values, [float(key) for key in keys],
+                                                [0, len(values)])
+
+        layers = {}
+        for key, (first, last, end) in zip(keys, runs):
+            first, last = first.tolist(), last.tolist()
+            layers[key] = ([times[i] for i in first],
+                           [times[i] for i in end.tolist()],
+                           [values[i:j].tolist() for i, j in zip(first, last)])
+        return layers
 
     def add_score_layer(self, score, start, dur, notes, key):
         ''' Add granular synth layer based on wind speed '''
@@ -151,53 +223,58 @@ class Cyclone():
             transpcoll, pitchjitter, 14, %s, %s)\n" \
             % (start, dur, cmix_pitches, self.pan(), self.pan()))
 
+    def add_score_layers(self, score, times, field):
+        ''' Add a granular synth layer for every interval in which field
+        exceeds one of the layer thresholds '''
+        for key, layer in self.layer_runs(times, field).items():
+            for start, end, notes in zip(*layer):
+                self.add_score_layer(score, start, end - start, notes, key)
+
     def set_audio_data(self, start, fps, sample_rate, scale, shift, field):
         ''' Determines audio start time and duration (in seconds) for cyclone,
         and transforms raw data to apporpriate pitches '''
         times = [start + i/(fps*sample_rate) for i in range(len(self.df.index))]
         dur_audio = times[-1] - times[0]
-        data_scaled = self.df[field]*scale + shift
+        data_scaled = np.asarray(self.df[field])*scale + shift
         return dur_audio, times, data_scaled
 
     def pitch_cmixline(self, data):
         ''' Converts array to list of pitches to be read by RTCMix. '''
-        indexes = np.arange(len(data))
+        data = np.asarray(data, dtype=float)
         cmixline = np.zeros(2*len(data))
         cmixline[1::2] = data
-        cmixline[0:-1:2] = indexes
-        pitches = str(cmixline.tolist()).strip('[').strip(']')
+        cmixline[0:-1:2] = np.arange(len(data))
+
+        # Shortest repr formatting of all values at once
+        pitches = ', '.join(cmixline.astype(str))
         pitch_cmd = "maketable(\"line\", \"nonorm\", 1000, " + pitches + ')\n'
         return pitch_cmd
 
-    def write_to_cmixscore(self, score, start, fps, \
-                            sample_rate, scale, shift, field):
-        ''' Adds GRANSYNTH instrument. Uses parameters from audio_data. '''
+    def audio_notes(self, start, fps, sample_rate, scale, shift, field):
+        ''' Returns GRANSYNTH notes for cyclone as (start, dur, amp, pitches,
+        pan) tuples, where pitches are the points of the pitch table. Storms
+        above 113 knots get two extra transposed layers. '''
         audio_data = self.set_audio_data(start, fps, sample_rate, scale, shift, field)
         dur, times, pitches = audio_data
         start = times[0]
-        
-        cmix_pitches = self.pitch_cmixline([x for x in pitches])
-        cat4_high_pitches = self.pitch_cmixline([x*1.1 for x in pitches])
-        cat4_low_pitches = self.pitch_cmixline([x/2.5 for x in pitches])
-        cat5_high_pitches = self.pitch_cmixline([1.5*x for x in pitches])
-        cat5_low_pitches = self.pitch_cmixline([x/2.5 for x in pitches])
-
-        # Write the base layer
-        score.write("GRANSYNTH(%s, %s, amp*1000, wave, granenv, hoptime,\
-        hopjitter, mindur, maxdur, minamp, 0.7*maxamp, %s,\
-        transpcoll, pitchjitter, 14, %s, %s)\n" % (start, dur, cmix_pitches,
-                                                   self.pan(), self.pan()))
+        pitches = np.asarray(pitches, dtype=float)
 
+        # Base layer
+        notes = [(start, dur, 1000., pitches, self.pan())]
 
         if float(self.df['max_wind'].max()) > 113.:
-            score.write("GRANSYNTH(%s, %s, amp*1000, wave, granenv, hoptime,\
-            hopjitter, mindur, maxdur, minamp, 0.7*maxamp, %s,\
-            transpcoll, pitchjitter, 14, %s, %s)\n" % (start, dur,
-                                                       cat4_high_pitches,
-                                                       self.pan(), self.pan()))
+            notes.append((start, dur, 1000., pitches*1.1, self.pan()))
+            notes.append((start, dur, 3500., pitches/2.5, self.pan()))
 
-            score.write("GRANSYNTH(%s, %s, amp*3500, wave, granenv, hoptime,\
-            hopjitter, mindur, maxdur, minamp, 0.7*maxamp, %s,\
-            transpcoll, pitchjitter, 14, %s, %s)\n" % (start, dur,
-                                                       cat4_low_pitches,
-                                                       self.pan(), self.pan()))
+        return notes
+
+    def write_to_cmixscore(self, score, start, fps, \
+                            sample_rate, scale, shift, field):
+        ''' Adds GRANSYNTH instrument. Uses parameters from audio_data. '''
+        for start, dur, amp, pitches, pan in self.audio_notes(start, fps, sample_rate,
+                                                              scale, shift, field):
+            score.write("GRANSYNTH(%s, %s, amp*%g, wave, granenv, hoptime,\
+        hopjitter, mindur, maxdur, minamp, 0.7*maxamp, %s,\
+        transpcoll, pitchjitter, 14, %s, %s)\n" % (start, dur, amp,
+                                                   self.pitch_cmixline(pitches),
+                                                   pan, pan))
@@ -0,0 +1,68 @@
+from read_data import HurricaneDatabase
+import multiprocessing as mp
+import os
+
+def load_ensemble(filenames, compact=True):
+    ''' Loads every run of an ensemble, by default into compact databases so
+    that all runs can stay in memory together. Returns list of databases. '''
+    databases = []
+    for filename in filenames:
+        d = HurricaneDatabase(compact)
+        d.load_data(filename)
+        databases.append(d)
+    return databases
+
+def up_to_date(inputs, outputs):
+    ''' Returns True if all outputs exist and are newer than every input '''
+    try:
+        oldest_output = min(os.path.getmtime(f) for f in outputs)
+    except (OSError, ValueError):
+        return False
+    newest_input = max([os.path.getmtime(f) for f in inputs if os.path.exists(f)],
+                       default=0.)
+    return oldest_output > newest_input
+
+# Per-process state of ensemble workers
+ensemble_state = {}
+
+def init_ensemble_worker(setup):
+    ''' Calls setup() once in a worker. What it returns (e.g. figure, map
+    projection and background) is shared by all runs of the worker. '''
+    ensemble_state['shared'] = setup() if setup is not None else None
+
+def run_worker(item):
+    ''' Processes one run with the worker's shared state '''
+    job, run = item
+    job(run, ensemble_state['shared'])
+    return run
+
+def run_ensemble(runs, job, inputs, outputs, setup=None, processes=None,
+                 force=False):
+    ''' Calls job(run, shared) for every run in a process pool, where shared
+    is what setup() returned in that worker. inputs(run) and outputs(run)
+    return lists of files; runs whose outputs are all newer than their inputs
+    are skipped unless force is set. job, setup, inputs and outputs must be
+    picklable (module level) functions. Returns the list of processed runs. '''
+    todo = []
+    for run in runs:
+        if not force and up_to_date(inputs(run), outputs(run)):
+            print("Skipping " + run + " (up to date)")
+        else:
+            todo.append(run)
+
+    # Nothing to do, so no worker (or setup) is needed
+    if not todo:
+        return []
+
+    items = [(job, run) for run in todo]
+    if processes == 1 or len(todo) <= 1:
+        init_ensemble_worker(setup)
+        done = [run_worker(item) for item in items]
+    else:
+        with mp.Pool(min(processes or os.cpu_count(), len(todo)),
+                     initializer=init_ensemble_worker, initargs=(setup,)) as pool:
+            done = []
+            for run in pool.imap_unordered(run_worker, items):
+                print("Finished " + run)
+                done.append(run)
+    return done
@@ -1,62 +1,126 @@
 # -*- coding: utf-8 -*-
 """
 Script for adding the RMW (radius of maximum wind) to the HURDAT data.
+
+The extended best track (EBTRK) file is parsed in bulk, missing (-99) RMW
+values are interpolated within each storm, and the result is stored as
+memory-mappable columns (storm, datetime, rmw) that HurricaneDatabase can
+join on (storm, datetime), e.g. with join_rmw.
 """
 
-import sys
+import sys, os, json
 import subprocess as sp
 import pandas as pd
-from collections import defaultdict
 import numpy as np
-import pickle
 
-def main():
-    base_name = sys.argv[1]
+def read_ebtrk(filename):
+    ''' Reads storm ID, datetime and RMW of every row of an EBTRK file in one
+    bulk parse. Returns dictionary of columns, with missing RMW values as NaN. '''
+    # Fields are: ID, name, MMDDHH, year, latitude, longitude, max wind,
+    # min pressure, RMW, ...
+    raw = pd.read_csv(filename, sep=r'\s+', header=None, usecols=[0, 2, 3, 8],
+                      names=['storm', 'date', 'year', 'rmw'],
+                      dtype={'storm': str, 'date': str, 'year': str, 'rmw': float})
 
-    repo_dir = sp.Popen(['git', 'rev-parse', '--show-toplevel'], stdout=sp.PIPE).communicate()[0].rstrip().decode("utf-8")
+    date_times = pd.to_datetime(raw['year'] + raw['date'].str.zfill(6),
+                                format='%Y%m%d%H')
+    rmw = raw['rmw'].to_numpy(dtype=float)
+    rmw[rmw == -99] = np.nan
 
-    # Load data
-    hurdat_data = repo_dir + "/data/" + base_name + ".txt"
-    ext_data = repo_dir + "/data/" + "ebtrk_atlc_1988_2017.txt"
+    return {'storm': raw['storm'].to_numpy(dtype=str),
+            'datetime': date_times.to_numpy(dtype='datetime64[ns]'),
+            'rmw': rmw}
+
+def group_storms(columns):
+    ''' Sorts rows by storm and datetime (keeping the last of duplicated rows).
+    Returns sorted columns and offsets of the rows of each storm. '''
+    order = np.lexsort((columns['datetime'], columns['storm']))
+    columns = {field: column[order] for field, column in columns.items()}
+
+    # Drop all but the last row of each (storm, datetime)
+    storms, date_times = columns['storm'], columns['datetime']
+    keep = np.ones(len(storms), dtype=bool)
+    keep[:-1] = (storms[1:] != storms[:-1]) | (date_times[1:] != date_times[:-1])
+    columns = {field: column[keep] for field, column in columns.items()}
+
+    storms = columns['storm']
+    starts = np.flatnonzero(np.r_[True, storms[1:] != storms[:-1]]) if len(storms) \
+             else np.zeros(0, dtype=np.int64)
+    offsets = np.append(starts, len(storms))
+    return columns, offsets
 
-    rmw_data = defaultdict(dict)
+def interpolate_groups(values, offsets, fill=0.):
+    ''' Linearly interpolates NaN values (by position) within each group of
+    rows offsets[k]:offsets[k + 1], for all groups at once. Values before
+    the first or after the last valid value of a group take that value;
+    groups without valid values are set to fill. '''
+    n = len(values)
+    position = np.arange(n)
+    valid = ~np.isnan(values)
 
-    with open(ext_data) as f:
-        l = True
-        name = ''
-        while l:
-            l = f.readline().strip().split()
-            if(len(l) == 0):
-                break
+    # Nearest valid row at or before, and at or after, each row
+    previous = np.maximum.accumulate(np.where(valid, position, -1))
+    following = np.minimum.accumulate(np.where(valid, position, n)[::-1])[::-1]
 
-            date, year, ID, rmw = l[2], l[3], l[0], l[8]
-            rmw_data[ID][date + '-' + year] = rmw
+    # Only valid rows of the same group count
+    group = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    has_previous = previous >= offsets[:-1][group]
+    has_following = following < offsets[1:][group]
+    previous = np.clip(previous, 0, max(n - 1, 0))
+    following = np.clip(following, 0, max(n - 1, 0))
 
-    for hurr, arr in rmw_data.items():
-        rmws = []
-        for dt, v in arr.items():
-            rmws.append(v)
+    result = np.full(n, fill, dtype=float)
+    both = has_previous & has_following
+    weight = (position - previous)/np.maximum(following - previous, 1)
+    result[both] = values[previous[both]] + weight[both]*(values[following[both]]
+                                                          - values[previous[both]])
+    only_previous = has_previous & ~has_following
+    result[only_previous] = values[previous[only_previous]]
+    only_following = ~has_previous & has_following
+    result[only_following] = values[following[only_following]]
+    return result
 
-        # Map values to ints and set '-99' values to nans
-        rmws = list(map(int, rmws))
-        rmws = [s if s != -99 else np.nan for s in rmws]
+def extend_rmw(filename):
+    ''' Returns columns (storm, datetime, rmw) of an EBTRK file, grouped by
+    storm, with missing RMW values interpolated within each storm (0 for
+    storms without any RMW values) '''
+    columns, offsets = group_storms(read_ebtrk(filename))
+    columns['rmw'] = interpolate_groups(columns['rmw'], offsets)
+    return columns
 
-        # Interpolate array
-        rmws_pd = pd.Series(rmws)
-        rmws_interp = rmws_pd.interpolate(limit=len(rmws), limit_direction='both')
+def write_rmw(path, columns):
+    ''' Writes columns as one .npy file each (plus a metadata file, written
+    last) in directory path '''
+    os.makedirs(path, exist_ok=True)
+    for field, column in columns.items():
+        np.save(os.path.join(path, field + '.npy'), column)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'columns': list(columns)}, f)
 
-        # If all are nans
-        if all(np.isnan(s) for s in rmws_interp):
-            rmws_interp = [0.]*len(rmws_interp)
+def read_rmw(path):
+    ''' Returns memory-mapped columns written by write_rmw '''
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    return {field: np.load(os.path.join(path, field + '.npy'), mmap_mode='r')
+            for field in meta['columns']}
 
-        # Reassign to interpolated wind speed values
-        for i, (dt, v) in enumerate(arr.items()):
-            rmw_data[hurr][dt] = rmws_interp[i]
+def join_rmw(d, path):
+    ''' Adds the 'rmw' column written by write_rmw to HurricaneDatabase d,
+    matching rows on cyclone ID and datetime (NaN where there is no match) '''
+    columns = read_rmw(path)
+    d.join_column('rmw', columns['storm'], columns['datetime'], columns['rmw'])
+
+def main():
+    base_name = sys.argv[1]
+
+    repo_dir = sp.Popen(['git', 'rev-parse', '--show-toplevel'], stdout=sp.PIPE).communicate()[0].rstrip().decode("utf-8")
+
+    # Load data
+    hurdat_data = repo_dir + "/data/" + base_name + ".txt"
+    ext_data = repo_dir + "/data/" + "ebtrk_atlc_1988_2017.txt"
 
-    # pickle dictionary
-    output = open('rmw_data.pkl', 'wb')
-    pickle.dump(rmw_data, output)
-    output.close()
+    # Write interpolated RMW columns
+    write_rmw('rmw_data', extend_rmw(ext_data))
 
 if __name__ == '__main__':
     main()
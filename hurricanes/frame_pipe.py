@@ -0,0 +1,91 @@
+import contextlib
+import subprocess as sp
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from background import prepare_canvas
+
+class RawVideoWriter():
+    ''' Writes frames rendered by the Agg canvas straight to an ffmpeg
+    subprocess as rawvideo, instead of going through savefig. Frames can be
+    downscaled by an integer factor (box filter) before they enter the pipe.
+    Has the saving()/grab_frame() interface of matplotlib's movie writers. '''
+    def __init__(self, fps=20, bitrate=None, codec='h264', downscale=1,
+                 extra_args=None, ffmpeg='ffmpeg'):
+        self.fps = fps
+        self.bitrate = bitrate
+        self.codec = codec
+        self.downscale = int(downscale)
+        self.extra_args = extra_args or []
+        self.ffmpeg = ffmpeg
+        self.proc = None
+
+    @contextlib.contextmanager
+    def saving(self, fig, outfile, dpi):
+        ''' Context manager starting ffmpeg and closing it when done '''
+        self.setup(fig, outfile, dpi)
+        try:
+            yield self
+        finally:
+            self.finish()
+
+    def setup(self, fig, outfile, dpi):
+        ''' Prepares Agg canvas and starts ffmpeg reading raw RGBA frames '''
+        self.fig = fig
+        if not isinstance(fig.canvas, FigureCanvasAgg):
+            FigureCanvasAgg(fig)
+        prepare_canvas(fig, dpi)
+
+        # Size of rendered frames and of frames sent down the pipe
+        self.width, self.height = [int(s) for s in fig.bbox.size]
+        f = self.downscale
+        self.out_width, self.out_height = self.width//f, self.height//f
+
+        cmd = [self.ffmpeg, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgba',
+               '-s', '%dx%d' % (self.out_width, self.out_height),
+               '-r', str(self.fps), '-i', 'pipe:',
+               '-vcodec', self.codec, '-pix_fmt', 'yuv420p']
+
+        # yuv420p needs even frame dimensions
+        if self.out_width % 2 or self.out_height % 2:
+            cmd += ['-vf', 'crop=trunc(iw/2)*2:trunc(ih/2)*2']
+        if self.bitrate is not None:
+            cmd += ['-b:v', '%dk' % self.bitrate]
+        cmd += self.extra_args + [outfile]
+
+        # Buffered stdin retries short writes; buffers larger than the
+        # buffer size are passed straight through without a copy
+        self.proc = sp.Popen(cmd, stdin=sp.PIPE)
+
+    def grab_frame(self, **savefig_kwargs):
+        ''' Draws the figure with the Agg canvas and writes it '''
+        self.fig.canvas.draw()
+        self.write_buffer(self.fig.canvas.buffer_rgba())
+
+    def write_buffer(self, buffer):
+        ''' Writes a raw RGBA frame (of the rendered size) to ffmpeg '''
+        if self.downscale > 1:
+            buffer = self.downscale_frame(buffer)
+        self.proc.stdin.write(buffer)
+
+    def downscale_frame(self, buffer):
+        ''' Averages f x f pixel blocks of frame '''
+        f = self.downscale
+        h, w = self.out_height, self.out_width
+        frame = np.frombuffer(buffer, dtype=np.uint8)
+        frame = frame.reshape(self.height, self.width, 4)
+
+        # Sum strided views (one per pixel in a block)
+        blocks = np.zeros((h, w, 4), dtype=np.uint16 if f <= 16 else np.uint32)
+        for i in range(f):
+            for j in range(f):
+                blocks += frame[i:h*f:f, j:w*f:f]
+        return (blocks//(f*f)).astype(np.uint8)
+
+    def finish(self):
+        ''' Closes the pipe and waits for ffmpeg to finish encoding '''
+        if self.proc is not None:
+            self.proc.stdin.close()
+            if self.proc.wait() != 0:
+                raise RuntimeError("ffmpeg exited with code %d" % self.proc.returncode)
+            self.proc = None
@@ -0,0 +1,176 @@
+import multiprocessing as mp
+import wave
+import numpy as np
+
+class GranularSynth():
+    ''' NumPy granular synthesizer modelled on the RTcmix GRANSYNTH instrument
+    and the tables set up in the score header of the examples. Notes are
+    (start, dur, amp, pitches, pan) tuples as returned by Cyclone.audio_notes:
+    start and dur in seconds, pitches the points of the pitch table written by
+    Cyclone.pitch_cmixline (in oct.pc) and pan the fraction sent to the left
+    channel. Amplitudes are in RTcmix units (full scale is 32768). '''
+    def __init__(self, rate=44100, amp_env=(0, 0, 1, 1, 2, 0.5, 3, 1, 4, 0),
+                 harmonics=(1, 0, 1, 0, 1, 0, 1, 0),
+                 hoptime=(0, 0.01, 1, 0.002, 2, 0.05), hopjitter=0.0001,
+                 mindur=0.04, maxdur=0.06, minamp=1.0, maxamp=0.7,
+                 transpositions=(0, .02, .03, .05, .07, .10), pitchjitter=1.0,
+                 seed=14, table_size=2000, block_grains=256):
+        self.rate = rate
+        self.amp_env = amp_env
+        self.hoptime = hoptime
+        self.hopjitter = hopjitter
+        self.mindur, self.maxdur = mindur, maxdur
+        self.minamp, self.maxamp = minamp, maxamp
+        self.seed = seed
+        self.block_grains = block_grains
+
+        # Grains pick transpositions from the first pitchjitter fraction of
+        # the collection
+        self.transpositions = self.octaves(np.asarray(transpositions, dtype=float))
+        self.n_transpositions = max(int(np.ceil(pitchjitter*len(transpositions))), 1)
+
+        # Normalized wavetable from partial amplitudes
+        phase = np.arange(table_size)/table_size
+        self.wavetable = sum(a*np.sin(2*np.pi*(h + 1)*phase)
+                             for h, a in enumerate(harmonics))
+        self.wavetable /= np.abs(self.wavetable).max()
+
+    @staticmethod
+    def line_table(points, x):
+        ''' Evaluates a "line" table of time, value pairs at positions x
+        (from 0 to 1 over the table) '''
+        times = np.asarray(points[0::2], dtype=float)
+        values = np.asarray(points[1::2], dtype=float)
+        return np.interp(x*times[-1], times, values)
+
+    @staticmethod
+    def octaves(pch):
+        ''' Converts oct.pc pitches to linear octaves '''
+        octave = np.floor(pch)
+        return octave + (pch - octave)*100./12.
+
+    def grain_onsets(self, dur, rng):
+        ''' Returns grain start times (s) within a note of length dur. The
+        grain rate follows the hoptime table and each onset is jittered. '''
+        # Cumulative grain count over a fine grid, inverted by interpolation
+        t = np.linspace(0., dur, max(int(dur*1000), 2))
+        rate = 1./self.line_table(self.hoptime, t/dur)
+        count = np.zeros(len(t))
+        count[1:] = np.cumsum(0.5*(rate[1:] + rate[:-1])*np.diff(t))
+        onsets = np.interp(np.arange(int(count[-1]) + 1), count, t)
+
+        onsets += rng.uniform(-self.hopjitter, self.hopjitter, len(onsets))
+        return np.clip(onsets, 0., dur)
+
+    def render_note(self, note, rng):
+        ''' Renders one note. Returns its first sample and a float32 array of
+        stereo samples (full scale is 1), or None for notes without duration. '''
+        start, dur, amp, pitches, pan = note
+        if dur <= 0:
+            return None
+        pitches = np.asarray(pitches, dtype=float)
+        pan = float(pan)
+
+        # Grain parameters, all drawn at once
+        onsets = self.grain_onsets(dur, rng)
+        n = len(onsets)
+        x = onsets/dur
+        durs = self.mindur + (self.maxdur - self.mindur)*rng.random(n)
+        lengths = np.maximum(durs*self.rate, 1).astype(np.int64)
+        amps = self.minamp + (self.maxamp - self.minamp)*rng.random(n)
+        gains = amp/32768.*self.line_table(self.amp_env, x)*amps
+        table = np.ravel(np.column_stack((np.arange(len(pitches)), pitches)))
+        transpositions = self.transpositions[rng.integers(0, self.n_transpositions, n)]
+        freqs = 261.6255653*2.**(self.octaves(self.line_table(table, x))
+                                 + transpositions - 8.)
+
+        first = int(round(start*self.rate))
+        positions = np.round(onsets*self.rate).astype(np.int64)
+        size = int(positions.max() + lengths.max())
+        left, right = np.zeros(size), np.zeros(size)
+
+        # Render grains in blocks of block_grains rows of samples
+        i = np.arange(lengths.max())
+        table_size = len(self.wavetable)
+        for b in range(0, n, self.block_grains):
+            block = slice(b, b + self.block_grains)
+            valid = i[None, :] < lengths[block, None]
+
+            phase = (freqs[block, None]*i[None, :]/self.rate) % 1.
+            env = 0.5 - 0.5*np.cos(2*np.pi*i[None, :]/lengths[block, None])
+            samples = self.wavetable[(phase*table_size).astype(np.int64)]*env
+            samples = (samples*gains[block, None])[valid]
+
+            index = (positions[block, None] + i[None, :])[valid]
+            left += np.bincount(index, samples*pan, minlength=size)
+            right += np.bincount(index, samples*(1. - pan), minlength=size)
+
+        return first, np.column_stack((left, right)).astype(np.float32)
+
+    def render(self, notes, filename, processes=None, chunk_seconds=10.):
+        ''' Renders notes (in a process pool unless processes is 1), mixes
+        them in start order into a float32 buffer and writes it to a 16 bit
+        stereo WAV file. Mixed audio is written in chunks of about
+        chunk_seconds once no later note can overlap it. '''
+        order = sorted(range(len(notes)), key=lambda k: notes[k][0])
+        items = [(k, notes[k]) for k in order]
+
+        with wave.open(filename, 'wb') as out:
+            out.setnchannels(2)
+            out.setsampwidth(2)
+            out.setframerate(self.rate)
+
+            if processes == 1:
+                init_synth(self)
+                self.mix(map(render_worker, items), out, chunk_seconds)
+            else:
+                with mp.Pool(processes, initializer=init_synth,
+                             initargs=(self,)) as pool:
+                    self.mix(pool.imap(render_worker, items, chunksize=16),
+                             out, chunk_seconds)
+
+    def mix(self, rendered, out, chunk_seconds):
+        ''' Adds rendered notes (in start order) into a float32 buffer,
+        writing out everything before the current note in chunks '''
+        chunk = int(chunk_seconds*self.rate)
+        buffer, offset = np.zeros((0, 2), dtype=np.float32), 0
+        for note in rendered:
+            if note is None:
+                continue
+            first, samples = note
+
+            # Samples before this note are final
+            if first - offset >= chunk:
+                done = min(first - offset, len(buffer))
+                self.write(out, buffer[:done])
+                buffer, offset = buffer[done:], offset + done
+                if first > offset:
+                    self.write(out, np.zeros((first - offset, 2), dtype=np.float32))
+                    offset = first
+
+            end = first - offset + len(samples)
+            if end > len(buffer):
+                buffer = np.concatenate((buffer, np.zeros((end - len(buffer), 2),
+                                                          dtype=np.float32)))
+            buffer[first - offset:end] += samples
+
+        self.write(out, buffer)
+
+    @staticmethod
+    def write(out, samples):
+        ''' Writes float32 stereo samples as clipped 16 bit frames '''
+        frames = np.clip(samples, -1., 1.)*32767.
+        out.writeframes(frames.astype('<i2').tobytes())
+
+# Per-process synthesizer of rendering workers
+synth_state = {}
+
+def init_synth(synth):
+    ''' Stores the synthesizer in a worker '''
+    synth_state['synth'] = synth
+
+def render_worker(item):
+    ''' Renders the k-th note, with a random stream that only depends on k '''
+    k, note = item
+    synth = synth_state['synth']
+    return synth.render_note(note, np.random.default_rng((synth.seed, k)))
@@ -0,0 +1,10 @@
+import os
+
+def headless():
+    ''' Switches matplotlib to the non-interactive Agg backend, so frames are
+    rendered without a display or GUI toolkit (e.g. on batch nodes). Call it
+    before animate_tracks or pyplot is imported. The backend is also set in
+    the environment, so worker processes started later render headless too. '''
+    os.environ['MPLBACKEND'] = 'Agg'
+    import matplotlib
+    matplotlib.use('Agg')
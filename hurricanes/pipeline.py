@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor
+import animate_tracks as at
+import sonify_tracks as st
+import subprocess as sp
+import contextlib
+import time
+
+class StageTimer():
+    ''' Records the wall time of named pipeline stages '''
+    def __init__(self):
+        self.times = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        ''' Context manager timing the stage it wraps '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = time.perf_counter() - start
+
+    def report(self):
+        ''' Prints wall time of each stage '''
+        for name, seconds in self.times.items():
+            print("{name:>10}: {seconds:8.2f} s".format(name=name, seconds=seconds))
+
+def generate(data, data_rcp, figure, writer, base_name, fps, sample_rate,
+             fade_inc, field, scale, shift, synth=None, cmix='CMIX',
+             ffmpeg='ffmpeg', animate_kwargs=None):
+    ''' Writes movie, audio and movie with sound (base_name + 'sound.mp4')
+    for one run. The data is loaded once; the animation runs in this thread
+    while a second thread writes the score and waits for CMIX (or renders
+    the audio with synth, a granular.GranularSynth, if given). The mux
+    starts as soon as both branches are done. region and window in
+    animate_kwargs select the same storms and time span for the audio.
+    Returns the StageTimer with the wall time of each stage. '''
+    timer = StageTimer()
+    animate_kwargs = animate_kwargs or {}
+    selection = {key: animate_kwargs[key] for key in ('region', 'window')
+                 if key in animate_kwargs}
+    score_name = base_name + '.sco'
+    sound_name = base_name + '.wav'
+
+    def audio(d):
+        ''' Writes the audio of the run '''
+        if synth is not None:
+            with timer.stage('synth'):
+                st.sonify_wav(data, sound_name, fps, sample_rate, field, scale,
+                              shift, synth=synth, d=d, **selection)
+            return
+
+        with timer.stage('score'):
+            with open(score_name, 'w') as f_out:
+                st.write_score_header(f_out, base_name)
+                st.sonify(data, f_out, fps, sample_rate, field, scale, shift, d=d,
+                          **selection)
+
+        with timer.stage('cmix'):
+            sp.run(cmix + ' < ' + score_name, shell=True, check=True)
+
+    with timer.stage('total'):
+        with timer.stage('load'):
+            loaded = at.load_animation_data(data, data_rcp)
+
+        # Matplotlib stays in this thread, the audio branch runs alongside
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            audio_done = executor.submit(audio, loaded[0])
+            with timer.stage('animate'):
+                at.animate(data, data_rcp, figure, writer, sample_rate, fade_inc,
+                           base_name, loaded=loaded, **animate_kwargs)
+            audio_done.result()
+
+        # Stich together with ffmpeg
+        with timer.stage('mux'):
+            sp.run([ffmpeg, '-y', '-i', base_name + '.mp4', '-i', sound_name,
+                    '-c:v', 'copy', '-c:a', 'aac', '-strict', 'experimental',
+                    base_name + 'sound.mp4'], check=True)
+
+    timer.report()
+    return timer
@@ -1,54 +1,507 @@
-import matplotlib.pyplot as plt
-import seaborn as sns
 import numpy as np
 import pandas as pd
 from functools import reduce
-import sys, pickle
+import sys, os, json, pickle, itertools, shutil, tempfile
+from collections import OrderedDict
+
+class EventView():
+    ''' Lightweight view of the rows start:stop of one event in the columns
+    of a HurricaneDatabase. Fields are read as NumPy slices (without copies)
+    and the datetime index is only built when asked for. '''
+    __slots__ = ('columns', 'start', 'stop')
+
+    def __init__(self, columns, start, stop):
+        self.columns = columns
+        self.start = start
+        self.stop = stop
+
+    def __getitem__(self, field):
+        return self.columns[field][self.start:self.stop]
+
+    def __len__(self):
+        return self.stop - self.start
+
+    @property
+    def index(self):
+        ''' Datetime index of the event rows '''
+        return pd.DatetimeIndex(self['datetime'], name='Datetime')
+
+    def to_frame(self, fields):
+        ''' Returns a dataframe with a copy of the given fields '''
+        return pd.DataFrame({field: np.array(self[field]) for field in fields},
+                            index=self.index)
 
 class HurricaneDatabase():
     ''' This object preprocesses and stores data from the converted model
-        data.'''
-    def __init__(self):
+        data. In compact mode, events are stored as EventViews into the
+        columns rather than dataframes, and coordinates as float32, so that
+        many runs (e.g. a whole ensemble) can be kept in memory.
+        In lazy mode, loading only indexes the event headers; events are
+        parsed when first asked for, and the last max_cached of them are kept. '''
+    def __init__(self, compact=False, lazy=False, max_cached=64):
+        self.compact = compact
+        self.lazy = lazy
+        self.max_cached = max_cached
         self.cyclone_IDs = []
         self.events = {}
         self.data_types = ['date', 'time','latitude', 'longitude', 'max_wind']
         self.valid_times = ['00:00:00', '06:00:00', '12:00:00', '18:00:00']
 
-    def load_data(self, filename):
+        # Contiguous columns for all events. Rows for the k-th event are
+        # stored in the slice offsets[k]:offsets[k + 1] of each column
+        self.raw_fields = ['latitude', 'longitude', 'max_wind']
+        self.fields = list(self.raw_fields)
+        self.coordinates = ['latitude', 'longitude']
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.columns = self.empty_columns()
+
+        # Interval between timesteps (shorter for resampled databases)
+        self.step = pd.Timedelta(hours=6)
+
+        # Aggregate statistics and lat/lon grid index of all track points,
+        # computed on first use (see stats and grid_index)
+        self.stats_cache = None
+        self.grid_cache = None
+        self.cell_size = 2.
+
+        # Lazy mode: source file, byte offset of the first row and first and
+        # last datetimes of each event, and the recently used events
+        self.sources = []
+        self.event_index = {'source': np.zeros(0, dtype=np.int64),
+                            'position': np.zeros(0, dtype=np.int64),
+                            'start': np.zeros(0, dtype='datetime64[ns]'),
+                            'end': np.zeros(0, dtype='datetime64[ns]')}
+        self.event_positions = {}
+        self.cached_events = OrderedDict()
+
+    def load_data(self, filename, cache=True):
         ''' Loads raw data from .txt file. Data is stored in 'event' dictionary.
         Data for a particular cyclone is accessed by entering the cyclone ID as a key:
-        e.g. data for cyclone with ID '0' is stored in events['0']. '''
-        # Read in data
+        e.g. data for cyclone with ID '0' is stored in events['0'].
+        If cache is set, parsed columns are stored in a binary cache next to
+        the source file and memory-mapped on later loads. In lazy mode only
+        the event headers are read (see index_events). '''
+        if self.lazy:
+            self.add_index(filename, *self.index_events(filename))
+            return
+
+        # Memory-map cached columns if they are still valid
+        data = self.read_cache(filename) if cache else None
+
+        # Otherwise read whole file into columns and cache them
+        if data is None:
+            data = self.read_columns(filename)
+            if cache:
+                self.write_cache(filename, *data)
+
+        # Build per-event frames from slices
+        self.add_columns(*data)
+
+    def empty_columns(self):
+        ''' Returns an empty set of columns '''
+        columns = {'event': np.zeros(0, dtype=np.int64),
+                   'datetime': np.zeros(0, dtype='datetime64[ns]')}
+        for field in self.raw_fields:
+            columns[field] = np.zeros(0)
+        return columns
+
+    def read_columns(self, filename):
+        ''' Scans raw .txt file once. Returns list of cyclone IDs, per-event
+        row offsets and a dictionary of NumPy columns (event, datetime,
+        latitude, longitude, max_wind). '''
         with open(filename) as f:
-            l = f.readline()
-            while l:
-                # Extract header arguments
-                header = [i.strip() for i in l.strip().split(',')]
-                cyclone_ID, n = header
+            lines = f.read().splitlines()
+
+        # Walk over headers and collect the rows of every event
+        cyclone_IDs, counts, rows = [], [], []
+        i = 0
+        while i < len(lines) and lines[i].strip():
+            cyclone_ID, n = [entry.strip() for entry in lines[i].split(',')]
+            cyclone_IDs.append(cyclone_ID)
+            counts.append(int(n))
+            rows += lines[i + 1:i + 1 + int(n)]
+            i += int(n) + 1
+
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+
+        # Parse all rows in bulk
+        columns = self.parse_rows(rows)
+        columns['event'] = np.repeat(np.arange(len(counts)), counts)
+
+        return cyclone_IDs, offsets, columns
+
+    def index_events(self, filename):
+        ''' Scans the headers of a .txt file, stepping over (but not parsing)
+        the rows. Returns list of cyclone IDs, per-event row offsets, byte
+        offsets of the first row of each event, and first and last datetimes
+        of each event (NaT for events without rows). '''
+        cyclone_IDs, counts, positions, bounds = [], [], [], []
+        position = 0
+        with open(filename, 'rb') as f:
+            for l in f:
+                position += len(l)
+                if not l.strip():
+                    break
+
+                # Extract header arguments and step over the event rows
+                cyclone_ID, n = [entry.strip() for entry in l.decode().split(',')]
+                rows = list(itertools.islice(f, int(n)))
+                cyclone_IDs.append(cyclone_ID)
+                counts.append(len(rows))
+                positions.append(position)
+                position += sum(len(row) for row in rows)
+                if rows:
+                    bounds += [rows[0].decode(), rows[-1].decode()]
+
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+
+        # Parse first and last rows in bulk
+        nonempty = np.asarray(counts) > 0
+        start = np.full(len(counts), np.datetime64('NaT'), dtype='datetime64[ns]')
+        end = start.copy()
+        date_times = self.parse_rows(bounds)['datetime']
+        start[nonempty], end[nonempty] = date_times[0::2], date_times[1::2]
+
+        return cyclone_IDs, offsets, np.asarray(positions, dtype=np.int64), start, end
+
+    def add_index(self, filename, cyclone_IDs, offsets, positions, start, end):
+        ''' Appends header index of the events of filename (lazy mode) '''
+        self.stats_cache = None
+        self.grid_cache = None
+        n_events, n_rows = len(self.cyclone_IDs), self.offsets[-1]
+        self.offsets = np.concatenate((self.offsets, offsets[1:] + n_rows))
+
+        index = {'source': np.full(len(cyclone_IDs), len(self.sources), dtype=np.int64),
+                 'position': positions, 'start': start, 'end': end}
+        for field, column in index.items():
+            self.event_index[field] = np.concatenate((self.event_index[field], column))
+        self.sources.append(filename)
+
+        for k, cyclone_ID in enumerate(cyclone_IDs):
+            self.cyclone_IDs.append(cyclone_ID)
+            self.event_positions[cyclone_ID] = n_events + k
+            self.cached_events.pop(cyclone_ID, None)
+
+    def read_event(self, k):
+        ''' Parses the k-th event from its source file (lazy mode) '''
+        n = int(self.offsets[k + 1] - self.offsets[k])
+        with open(self.sources[self.event_index['source'][k]], 'rb') as f:
+            f.seek(self.event_index['position'][k])
+            rows = [row.decode() for row in itertools.islice(f, n)]
+
+        columns = self.parse_rows(rows)
+        if self.compact:
+            for field in self.coordinates:
+                columns[field] = columns[field].astype(np.float32)
+            return EventView(columns, 0, n)
+        return self.frame_from_slice(columns, 0, n)
+
+    def parse_rows(self, rows):
+        ''' Parses raw data rows into datetime and numerical columns '''
+        raw = np.loadtxt(rows, delimiter=',', ndmin=2) if rows else np.zeros((0, 5))
+
+        columns = {'datetime': self.parse_date_times(raw[:, 0], raw[:, 1])}
+        for k, field in enumerate(self.raw_fields):
+            columns[field] = np.ascontiguousarray(raw[:, k + 2])
+        return columns
+
+    def iter_events(self, filename):
+        ''' Reads events from .txt file one at a time, without storing them.
+        Yields cyclone ID and dataframe for each event in file order. '''
+        with open(filename) as f:
+            for l in f:
+                if not l.strip():
+                    break
+
+                # Extract header arguments and parse the event rows
+                cyclone_ID, n = [entry.strip() for entry in l.split(',')]
+                columns = self.parse_rows(list(itertools.islice(f, int(n))))
+                yield cyclone_ID, self.frame_from_slice(columns, 0, int(n))
 
-                # Add new event
-                self.add_event(cyclone_ID)
+    @staticmethod
+    def parse_date_times(dates, times):
+        ''' Converts raw YYYYMMDD dates and HHMM times to datetime64 '''
+        dates, times = dates.astype(np.int64), times.astype(np.int64)
+        years, months, days = dates//10000, (dates//100) % 100, dates % 100
+
+        # Build datetimes from year, month and day offsets
+        date_times = (years - 1970).astype('datetime64[Y]')
+        date_times = date_times.astype('datetime64[M]') + (months - 1)
+        date_times = date_times.astype('datetime64[D]') + (days - 1)
+        date_times = date_times.astype('datetime64[ns]')
+        date_times += (times//100).astype('timedelta64[h]')
+        date_times += (times % 100).astype('timedelta64[m]')
+        return date_times
 
-                # Add event data for each timestamp
-                for i in range(int(n)):
-                    self.add_entry(cyclone_ID, self.read_row(f.readline()))
-                l = f.readline()
+    @staticmethod
+    def resample_columns(offsets, columns, step):
+        ''' Linearly interpolates every column of all events at once to times
+        t0 + j*step, where t0 is the first datetime of each event (step is a
+        timedelta64). Longitudes follow the shortest way around (so tracks
+        crossing 0/360 stay continuous) and are returned modulo 360.
+        Returns resampled offsets and columns. '''
+        offsets = np.asarray(offsets, dtype=np.int64)
+        counts = np.diff(offsets)
+        nonempty = counts > 0
+        date_times = columns['datetime']
+
+        # Hours since the start of each event, for source rows and new rows
+        first = offsets[:-1][nonempty]
+        t0 = np.zeros(len(counts), dtype='datetime64[ns]')
+        t0[nonempty] = date_times[first]
+        duration = np.zeros(len(counts), dtype='timedelta64[ns]')
+        duration[nonempty] = date_times[offsets[1:][nonempty] - 1] - date_times[first]
+        event = np.repeat(np.arange(len(counts)), counts)
+        hours = (date_times - t0[event])/np.timedelta64(1, 'h')
+
+        step_hours = step/np.timedelta64(1, 'h')
+        new_counts = np.where(nonempty, duration//step + 1, 0).astype(np.int64)
+        new_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        new_offsets[1:] = np.cumsum(new_counts)
+        new_event = np.repeat(np.arange(len(counts)), new_counts)
+        j = np.arange(new_offsets[-1]) - new_offsets[:-1][new_event]
+        new_hours = j*step_hours
+
+        # Source segment of each new row: events are spaced further apart
+        # than any event lasts, so one search over all rows finds it
+        span = float(hours.max()) + 1. if len(hours) else 1.
+        i = np.searchsorted(event*span + hours, new_event*span + new_hours,
+                            side='right') - 1
+        i = np.clip(i, offsets[:-1][new_event],
+                    np.maximum(offsets[1:][new_event] - 2, offsets[:-1][new_event]))
+        following = np.minimum(i + 1, offsets[1:][new_event] - 1)
+        gap = hours[following] - hours[i]
+        weight = np.where(gap > 0, (new_hours - hours[i])/np.where(gap > 0, gap, 1.), 0.)
+
+        resampled = {'event': new_event,
+                     'datetime': t0[new_event] + (j*step).astype('timedelta64[ns]')}
+        for field, column in columns.items():
+            if field in resampled:
+                continue
+            column = np.asarray(column, dtype=float)
+            change = column[following] - column[i]
+            if field == 'longitude':
+                change = (change + 180.) % 360. - 180.
+            # Rows at source times take the source value, so a NaN at the
+            # other end of the segment does not spread to them
+            values = column[i] + weight*change
+            values = np.where(weight == 0., column[i], values)
+            resampled[field] = np.where(weight == 1., column[following], values)
+            if field == 'longitude':
+                resampled[field] %= 360.
+        return new_offsets, resampled
+
+    def resample(self, step):
+        ''' Returns a new database with all events resampled to step (anything
+        pd.Timedelta takes, e.g. '30min'), which must divide 6 hours so that
+        events still start on the timestep grid. Its datetimes() are at step
+        intervals, so animating it draws one segment per step. '''
+        step = pd.Timedelta(step)
+        if step <= pd.Timedelta(0) or pd.Timedelta(hours=6) % step != pd.Timedelta(0):
+            raise ValueError("step must divide 6 hours, got %s" % step)
+
+        offsets, columns = self.all_columns()
+        offsets, columns = self.resample_columns(offsets, columns, step.to_timedelta64())
+
+        d = HurricaneDatabase(self.compact)
+        d.fields = list(self.fields)
+        d.step = step
+        d.add_columns(list(self.cyclone_IDs), offsets, columns)
+        return d
 
-                # Set index to datetime
-                self.events[cyclone_ID] = self.index_as_date_time(self.events[cyclone_ID])
+    @staticmethod
+    def threshold_runs(values, thresholds, offsets):
+        ''' Finds runs of rows where values >= threshold, for all thresholds in
+        one pass. Runs never cross the event boundaries given by offsets.
+        Returns, per threshold, arrays of the first row, the stop row
+        (exclusive) and the end row of each run. The end row is the first row
+        below threshold, or the last row of the event if the run reaches it.
+        Single row runs are dropped unless they reach the end of the event. '''
+        values = np.asarray(values, dtype=float)
+        thresholds = np.asarray(thresholds, dtype=float)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        n = len(values)
+
+        # Rows opening and closing each event
+        event_first, event_last = np.zeros(n, dtype=bool), np.zeros(n, dtype=bool)
+        event_first[offsets[:-1][offsets[:-1] < n]] = True
+        event_last[offsets[1:][offsets[1:] > 0] - 1] = True
+
+        # Runs open where the mask switches on, and close where it switches off
+        mask = values[None, :] >= thresholds[:, None]
+        change = np.diff(mask.astype(np.int8), axis=1, prepend=0, append=0)
+        rows, first = np.nonzero((change[:, :-1] == 1) | (mask & event_first))
+        _, last = np.nonzero((change[:, 1:] == -1) | (mask & event_last))
+        last = last + 1
+
+        at_end = event_last[last - 1]
+        end = np.where(at_end, last - 1, last)
+        keep = (last - first > 1) | at_end
+
+        runs = []
+        for t in range(len(thresholds)):
+            selected = keep & (rows == t)
+            runs.append((first[selected], last[selected], end[selected]))
+        return runs
 
-                # Convert numerical data from str to float
-                self.events[cyclone_ID] = self.convert_to_floats(self.events[cyclone_ID])
+    @staticmethod
+    def cache_path(filename):
+        ''' Returns the columnar cache of a source file: a link to the
+        directory holding the current version of the cache '''
+        return os.path.splitext(filename)[0] + '.cache'
+
+    @staticmethod
+    def source_signature(filename):
+        ''' Returns modification time and size used to validate the cache '''
+        stat = os.stat(filename)
+        return {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+    def write_cache(self, filename, cyclone_IDs, offsets, columns):
+        ''' Writes one .npy file per column plus a metadata file into a new
+        directory, then atomically points the cache link at it. Files of
+        earlier versions, which other processes may have memory-mapped, are
+        unlinked but never truncated or rewritten. '''
+        path = self.cache_path(filename)
+        parent, name = os.path.split(os.path.abspath(path))
+        version = None
+        try:
+            version = tempfile.mkdtemp(prefix=name + '.', dir=parent)
+            np.save(os.path.join(version, 'offsets.npy'), offsets)
+            for field, column in columns.items():
+                np.save(os.path.join(version, field + '.npy'), column)
+
+            meta = {'source': self.source_signature(filename),
+                    'cyclone_IDs': cyclone_IDs, 'columns': list(columns)}
+            with open(os.path.join(version, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+
+            # Swap the link to the new version
+            previous = os.path.realpath(path) if os.path.islink(path) else None
+            if os.path.isdir(path) and not os.path.islink(path):
+                # Cache directory written in place by older versions
+                shutil.rmtree(path)
+            link = version + '.link'
+            os.symlink(os.path.basename(version), link)
+            os.replace(link, path)
+            version = None
+
+            if previous is not None and previous != os.path.realpath(path):
+                shutil.rmtree(previous, ignore_errors=True)
+        except OSError:
+            # Caching is best effort (e.g. read-only data directory)
+            if version is not None:
+                shutil.rmtree(version, ignore_errors=True)
+                if os.path.lexists(version + '.link'):
+                    os.remove(version + '.link')
+
+    def read_cache(self, filename):
+        ''' Returns memory-mapped cached columns, or None if there is no cache
+        or the source file changed since it was written '''
+        # All files are read from the version the link points to now
+        path = os.path.realpath(self.cache_path(filename))
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            if meta['source'] != self.source_signature(filename):
+                return None
+
+            offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+            columns = {field: np.load(os.path.join(path, field + '.npy'), mmap_mode='r')
+                       for field in meta['columns']}
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return meta['cyclone_IDs'], offsets, columns
+
+    def add_columns(self, cyclone_IDs, offsets, columns):
+        ''' Appends columnar data for new events and builds their frames (or
+        views in compact mode) '''
+        self.stats_cache = None
+        self.grid_cache = None
+        n_events, n_rows = len(self.cyclone_IDs), self.offsets[-1]
+        if self.compact:
+            columns = dict(columns)
+            for field in self.coordinates:
+                columns[field] = np.asarray(columns[field], dtype=np.float32)
+
+        if n_events == 0:
+            # Keep columns as given (they may be memory-mapped)
+            self.columns, self.offsets = dict(columns), offsets
+        else:
+            # Shift event numbers and offsets past the events already stored
+            for field, column in columns.items():
+                if field == 'event':
+                    column = column + n_events
+                self.columns[field] = np.concatenate((self.columns[field], column))
+            self.offsets = np.concatenate((self.offsets, offsets[1:] + n_rows))
+
+            # Joined columns have no values for the new rows
+            n_new = int(offsets[-1])
+            for field in set(self.columns) - set(columns):
+                self.columns[field] = np.concatenate((self.columns[field],
+                                                      np.full(n_new, np.nan)))
+
+        # Per-event frames are built from slices of the columns. Views share
+        # the columns dictionary, so they follow later appends.
+        for k, cyclone_ID in enumerate(cyclone_IDs):
+            self.cyclone_IDs.append(cyclone_ID)
+            if self.compact:
+                self.events[cyclone_ID] = EventView(self.columns,
+                                                    int(self.offsets[n_events + k]),
+                                                    int(self.offsets[n_events + k + 1]))
+            else:
+                self.events[cyclone_ID] = self.frame_from_slice(self.columns,
+                                                                self.offsets[n_events + k],
+                                                                self.offsets[n_events + k + 1])
+
+    def join_column(self, field, storms, date_times, values):
+        ''' Adds field as a new column, taking values of the rows matching the
+        (cyclone ID, datetime) pairs of storms and date_times (NaN for rows
+        without a match) '''
+        if self.lazy:
+            raise ValueError("join_column is not supported in lazy mode")
+        self.stats_cache = None
+        self.grid_cache = None
+        IDs = np.asarray(self.cyclone_IDs, dtype=str)[self.columns['event']] \
+              if len(self.cyclone_IDs) else np.zeros(0, dtype=str)
+        rows = pd.MultiIndex.from_arrays([IDs, self.columns['datetime']])
+        keys = pd.MultiIndex.from_arrays([np.asarray(storms, dtype=str),
+                                          np.asarray(date_times)])
+        match = keys.get_indexer(rows)
+
+        column = np.full(len(match), np.nan)
+        column[match >= 0] = np.asarray(values, dtype=float)[match[match >= 0]]
+        self.columns[field] = column
+        if field not in self.fields:
+            self.fields.append(field)
+
+        # Frames (views read the columns directly)
+        if not self.compact:
+            for k, cyclone_ID in enumerate(self.cyclone_IDs):
+                self.events[cyclone_ID][field] = column[self.offsets[k]:self.offsets[k + 1]]
+
+    def frame_from_slice(self, columns, start, end):
+        ''' Returns dataframe indexed by datetime for rows start:end '''
+        index = pd.DatetimeIndex(columns['datetime'][start:end], name='Datetime')
+        return pd.DataFrame({field: columns[field][start:end] for field in self.fields
+                             if field in columns},
+                            index=index)
 
     def add_event(self, cyclone_ID):
         ''' Adds new key to events dict '''
         # Add event and initialize dataframe
+        self.stats_cache = None
+        self.grid_cache = None
         self.cyclone_IDs.append(cyclone_ID)
         self.events[cyclone_ID] = pd.DataFrame(columns=self.data_types)
 
     def add_entry(self, cyclone_ID, row):
         ''' Adds new data line for given cyclone ID '''
         # Add row to dataframe
+        self.stats_cache = None
+        self.grid_cache = None
         length = self.events[cyclone_ID].shape[0]
         self.events[cyclone_ID].loc[length] = row
 
@@ -90,36 +543,291 @@ class HurricaneDatabase():
         return df
 
     def event_data(self, cyclone_ID):
-        ''' Returns data for a given cyclone ID '''
-        return self.events[cyclone_ID]
+        ''' Returns data for a given cyclone ID (an EventView in compact mode).
+        In lazy mode the event is parsed on first use and kept while it is
+        among the max_cached most recently used events. '''
+        if not self.lazy:
+            return self.events[cyclone_ID]
+
+        if cyclone_ID in self.cached_events:
+            self.cached_events.move_to_end(cyclone_ID)
+            return self.cached_events[cyclone_ID]
+
+        event = self.read_event(self.event_positions[cyclone_ID])
+        self.cached_events[cyclone_ID] = event
+        if len(self.cached_events) > self.max_cached:
+            self.cached_events.popitem(last=False)
+        return event
+
+    def all_columns(self):
+        ''' Returns row offsets and columns of all events. In lazy mode the
+        source files are read in bulk (from their caches if valid) and the
+        columns are not kept. '''
+        if not self.lazy:
+            return np.asarray(self.offsets), self.columns
+
+        parts, n_events = [], 0
+        for filename in self.sources:
+            data = self.read_cache(filename) or self.read_columns(filename)
+            part = dict(data[2])
+            part['event'] = part['event'] + n_events
+            parts.append(part)
+            n_events += len(data[0])
+
+        columns = self.empty_columns()
+        for field in columns:
+            columns[field] = np.concatenate([columns[field]] + [p[field] for p in parts])
+        return np.asarray(self.offsets), columns
+
+    def event_bounds(self):
+        ''' Returns first and last datetimes of each event (NaT for events
+        without rows) '''
+        if self.lazy:
+            return self.event_index['start'], self.event_index['end']
+
+        offsets = np.asarray(self.offsets)
+        nonempty = np.diff(offsets) > 0
+        start = np.full(len(nonempty), np.datetime64('NaT'), dtype='datetime64[ns]')
+        end = start.copy()
+        start[nonempty] = self.columns['datetime'][offsets[:-1][nonempty]]
+        end[nonempty] = self.columns['datetime'][offsets[1:][nonempty] - 1]
+        return start, end
 
     def list_events(self):
         ''' Lists all recorded events by cyclone ID '''
         return self.cyclone_IDs
 
+    def stats(self):
+        ''' Returns aggregate statistics of all events, computed in one pass
+        over the columns and kept until more data is loaded:
+        'ranges' maps each field to its (min, max) value,
+        'storms' is a dataframe of per-storm summaries indexed by cyclone ID
+        (start, end, duration in hours, peak wind and genesis location),
+        'annual_counts' counts storms by starting year. '''
+        if self.stats_cache is not None:
+            return self.stats_cache
+
+        offsets, columns = self.all_columns()
+        nonempty = np.diff(offsets) > 0
+        first, last = offsets[:-1][nonempty], offsets[1:][nonempty] - 1
+
+        # Global min/max of each field (missing values are ignored)
+        ranges = {}
+        for field in self.fields:
+            column = np.asarray(columns[field])
+            ranges[field] = (np.nanmin(column), np.nanmax(column)) if len(column) \
+                            else (np.nan, np.nan)
+
+        # Per-storm summaries
+        start = pd.DatetimeIndex(columns['datetime'][first])
+        end = pd.DatetimeIndex(columns['datetime'][last])
+        peak_wind = np.fmax.reduceat(columns['max_wind'], first) if len(first) \
+                    else np.zeros(0)
+        IDs = [ID for ID, n in zip(self.cyclone_IDs, nonempty) if n]
+        storms = pd.DataFrame({'start': start, 'end': end,
+                               'duration': (end - start)/pd.Timedelta(hours=1),
+                               'peak_wind': peak_wind,
+                               'genesis_latitude': columns['latitude'][first],
+                               'genesis_longitude': columns['longitude'][first]},
+                              index=pd.Index(IDs, name='cyclone_ID'))
+
+        # Storm counts per starting year
+        annual_counts = pd.DataFrame({'year': start.year})['year'].value_counts(sort=False)
+
+        self.stats_cache = {'ranges': ranges, 'storms': storms,
+                            'annual_counts': annual_counts}
+        return self.stats_cache
+
     def datetimes(self):
-        ''' Returns all datetimes from start to end at 6 hour intervals '''
-        # Start
-        t_start = (self.event_data(self.list_events()[0]).head(1).index)[0]
+        ''' Returns all datetimes from start to end at step intervals (6 hours
+        unless resampled) '''
+        # Start of first cyclone and final date in season
+        start, end = self.event_bounds()
+        t_start = pd.Timestamp(start[~np.isnat(start)][0])
+        t_end = pd.Timestamp(end[~np.isnat(end)].max())
 
-        # End of first cyclone (this will be updated)
-        t_end = (self.event_data(self.list_events()[0]).tail(1).index)[0]
+        # Date range in step intervals
+        drange = pd.date_range(t_start, t_end, freq=self.step)
 
-        # Loop over events and set final date in season
-        for k in range(1, len(self.list_events())):
-            t_end_current = (self.event_data(self.list_events()[k]).tail(1).index)[0]
-            if t_end_current > t_end:
-                t_end = t_end_current
+        return drange
 
-        # Date range in 6 hourly intervals
-        drange = pd.date_range(t_start, t_end, freq='6H')
+    def interval_index(self):
+        ''' Returns two dictionaries mapping a timestep (position in datetimes())
+        to the positions in list_events() of the events that start, or end, at
+        that step. An event ends at the first step after its last datetime.
+        Events that do not start on a timestep are never active. '''
+        date_times = self.datetimes().values
+        t_start, t_end = self.event_bounds()
+
+        # Starting step of each event (only exact matches with the grid count)
+        start_steps = np.searchsorted(date_times, t_start)
+        valid = start_steps < len(date_times)
+        valid[valid] = date_times[start_steps[valid]] == t_start[valid]
+
+        # First step after the end of each event
+        end_steps = np.searchsorted(date_times, t_end, side='right')
+
+        starts, ends = {}, {}
+        for e in np.flatnonzero(valid).tolist():
+            starts.setdefault(int(start_steps[e]), []).append(e)
+            ends.setdefault(int(end_steps[e]), []).append(e)
+
+        return starts, ends
+
+    def layer_runs(self, field, thresholds):
+        ''' Finds threshold runs of field for all events at once. Returns, per
+        threshold, arrays of event positions (in list_events()) and the first,
+        stop and end rows of each run (see threshold_runs). '''
+        offsets, columns = self.all_columns()
+        runs = self.threshold_runs(columns[field], thresholds, offsets)
+        return [(columns['event'][first], first, last, end)
+                for first, last, end in runs]
+
+    def grid_index(self):
+        ''' Returns grid index of all track points (computed on first use).
+        Points are sorted by the cell_size x cell_size degree lat/lon cell
+        they fall in; cell[i] is the cell of point i (sorted), row[i] its row
+        in the columns. Longitudes are taken modulo 360. '''
+        if self.grid_cache is not None:
+            return self.grid_cache
+
+        offsets, columns = self.all_columns()
+        n_lon = int(np.ceil(360./self.cell_size))
+        latitude = np.asarray(columns['latitude'], dtype=float)
+        longitude = np.asarray(columns['longitude'], dtype=float) % 360.
+        cells = (np.floor((latitude + 90.)/self.cell_size).astype(np.int64)*n_lon
+                 + np.floor(longitude/self.cell_size).astype(np.int64) % n_lon)
+
+        order = np.argsort(cells, kind='stable')
+        self.grid_cache = {'n_lon': n_lon, 'cell': cells[order], 'row': order,
+                           'latitude': latitude[order], 'longitude': longitude[order],
+                           'datetime': columns['datetime'][order],
+                           'event': columns['event'][order]}
+        return self.grid_cache
+
+    def region_points(self, region):
+        ''' Returns positions (in grid_index order) of the points inside
+        region = (lat_min, lat_max, lon_min, lon_max). A region with
+        lon_min > lon_max (modulo 360) crosses the 0 meridian; one spanning
+        360 degrees or more covers all longitudes. '''
+        grid = self.grid_index()
+        lat_min, lat_max, lon_min, lon_max = region
+        all_longitudes = lon_max - lon_min >= 360.
+        lon_min, lon_max = lon_min % 360., lon_max % 360.
+
+        # Cell columns covered by the region, split at the 0 meridian
+        n_lon, size = grid['n_lon'], self.cell_size
+        if all_longitudes or lon_min > lon_max and lon_max//size >= lon_min//size:
+            # Every cell column (the wrapped spans would overlap)
+            spans = [(0., 360.)]
+        elif lon_min <= lon_max:
+            spans = [(lon_min, lon_max)]
+        else:
+            spans = [(lon_min, 360.), (0., lon_max)]
+        bounds = []
+        for i in range(int(np.floor((lat_min + 90.)/size)),
+                       int(np.floor((lat_max + 90.)/size)) + 1):
+            for west, east in spans:
+                bounds.append((i*n_lon + int(west//size),
+                               i*n_lon + min(int(east//size), n_lon - 1) + 1))
+
+        # Points of the covered cells, then exact test at the region edges
+        bounds = np.asarray(bounds, dtype=np.int64).reshape(-1, 2)
+        first = np.searchsorted(grid['cell'], bounds[:, 0])
+        stop = np.searchsorted(grid['cell'], bounds[:, 1])
+        points = np.concatenate([np.arange(a, b) for a, b in zip(first, stop)] +
+                                [np.zeros(0, dtype=np.int64)])
+
+        latitude, longitude = grid['latitude'][points], grid['longitude'][points]
+        inside = (latitude >= lat_min) & (latitude <= lat_max)
+        if all_longitudes:
+            return points[inside]
+        if lon_min <= lon_max:
+            inside &= (longitude >= lon_min) & (longitude <= lon_max)
+        else:
+            inside &= (longitude >= lon_min) | (longitude <= lon_max)
+        return points[inside]
 
-        return drange
+    @staticmethod
+    def window_bounds(window):
+        ''' Returns (start, end) of a time window as datetime64 (open ends as
+        NaT). window is a (start, end) pair of anything pd.Timestamp takes. '''
+        return tuple(np.datetime64('NaT', 'ns') if t is None else
+                     pd.Timestamp(t).to_datetime64().astype('datetime64[ns]')
+                     for t in window)
+
+    def query(self, region=None, window=None):
+        ''' Returns positions (in list_events()) of the events with at least one
+        point inside region = (lat_min, lat_max, lon_min, lon_max) and, if a
+        window = (start, end) is given, inside that window. Without region,
+        returns the events overlapping the window. Either end of window may
+        be None. '''
+        if region is None:
+            start, end = self.event_bounds()
+            selected = ~np.isnat(start)
+            if window is not None:
+                t_start, t_end = self.window_bounds(window)
+                if not np.isnat(t_start):
+                    selected &= end >= t_start
+                if not np.isnat(t_end):
+                    selected &= start <= t_end
+            return np.flatnonzero(selected)
+
+        grid = self.grid_index()
+        points = self.region_points(region)
+        if window is not None:
+            points = points[self.in_window(grid['datetime'][points], window)]
+        return np.unique(grid['event'][points])
+
+    def query_events(self, region=None, window=None):
+        ''' Returns cyclone IDs of the events matching region and window (see query) '''
+        return [self.cyclone_IDs[e] for e in self.query(region, window).tolist()]
+
+    def query_points(self, region=None, window=None):
+        ''' Returns rows (in the columns, i.e. offsets[k] + i for point i of
+        event k) of the points inside region and window, in row order '''
+        if region is not None:
+            grid = self.grid_index()
+            points = self.region_points(region)
+            if window is not None:
+                points = points[self.in_window(grid['datetime'][points], window)]
+            return np.sort(grid['row'][points])
+
+        # Only rows of the events overlapping the window need to be tested
+        offsets = np.asarray(self.offsets)
+        events = self.query(window=window)
+        rows = np.concatenate([np.arange(offsets[e], offsets[e + 1]) for e in events] +
+                              [np.zeros(0, dtype=np.int64)])
+        if window is not None:
+            rows = rows[self.in_window(self.all_columns()[1]['datetime'][rows], window)]
+        return rows
+
+    def in_window(self, date_times, window):
+        ''' Returns mask of date_times inside window '''
+        t_start, t_end = self.window_bounds(window)
+        inside = np.ones(len(date_times), dtype=bool)
+        if not np.isnat(t_start):
+            inside &= date_times >= t_start
+        if not np.isnat(t_end):
+            inside &= date_times <= t_end
+        return inside
+
+    def window_steps(self, window=None):
+        ''' Returns first and stop timesteps (positions in datetimes()) of window '''
+        date_times = self.datetimes().values
+        if window is None:
+            return 0, len(date_times)
+        t_start, t_end = self.window_bounds(window)
+        first = 0 if np.isnat(t_start) else int(np.searchsorted(date_times, t_start))
+        stop = len(date_times) if np.isnat(t_end) else \
+               int(np.searchsorted(date_times, t_end, side='right'))
+        return first, stop
 
     def total_hours(self):
         # Get start and end datetimes of full dataset
-        t_start = (self.event_data(self.list_events()[0]).head(1).index)[0]
-        t_end   = (self.event_data(self.list_events()[-1]).tail(1).index)[0]
+        start, end = self.event_bounds()
+        t_start = pd.Timestamp(start[~np.isnat(start)][0])
+        t_end = pd.Timestamp(end[~np.isnat(end)][-1])
 
         # Total hours in dataset
         tot_hours = (t_end - t_start).days*24.
@@ -127,38 +835,21 @@ class HurricaneDatabase():
 
     def data_range(self, field):
         ''' Determine the max and min values for column '''
-        # Set the global max/min values of field to max/min of first event
-        events = self.list_events()
-        min_v = (self.event_data(events[0])[field]).min()
-        max_v = (self.event_data(events[0])[field]).max()
+        return self.stats()['ranges'][field]
 
-        # Iterate through all events and update global max/min
-        for e in self.list_events()[1:]:
-            df = self.event_data(e)
-            # Check minimum
-            if (df[field].min() < min_v):
-                min_v = df[field].min()
-
-            # Check maximum
-            if (df[field].max() > max_v):
-                max_v = df[field].max()
-
-        return min_v, max_v
+    @staticmethod
+    def merged_range(databases, field):
+        ''' Determine the max and min values for column over several
+        databases (e.g. the runs of an ensemble) '''
+        ranges = [d.data_range(field) for d in databases]
+        return min(r[0] for r in ranges), max(r[1] for r in ranges)
 
     def plot_annual_frequency(self,title):
         ''' Bar plot of annual storm frequencies '''
-        # Get starting data for each storm
-        starting_dates = []
-        for event in self.cyclone_IDs:
-            storm = self.event_data(event)
-            starting_dates.append(storm.index[0].year)
-
-        # Create data frame
-        df = pd.DataFrame({'year' : starting_dates})
-
         # Plot storm frequency per year
+        #import matplotlib.pyplot as plt
         #fig, ax = plt.subplots()
-        counts = df['year'].value_counts(sort=False)
+        counts = self.stats()['annual_counts']
         #counts.plot(ax=ax,kind='bar',color='b')
 
         # Plot average
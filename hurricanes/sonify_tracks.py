@@ -1,25 +1,157 @@
 from read_data import HurricaneDatabase
 from cyclone import Cyclone
-import matplotlib.pyplot as plt
+from granular import GranularSynth
+from telemetry import NullTelemetry
 import numpy as np
+import pandas as pd
 import subprocess as sp
 
-def sonify(data, score, fps, sample_rate, field, scale, shift):
-    ''' Sonifies all tracks in dataset '''
+class ScoreBuffer():
+    ''' Collects score lines and writes them to the score in large batches '''
+    def __init__(self, score, size=2**20):
+        self.score = score
+        self.size = size
+        self.lines, self.length = [], 0
+
+    def write(self, line):
+        ''' Adds line, writing out the batch once it reaches size characters '''
+        self.lines.append(line)
+        self.length += len(line)
+        if self.length >= self.size:
+            self.flush()
+
+    def flush(self):
+        ''' Writes all collected lines to the score '''
+        self.score.write(''.join(self.lines))
+        self.lines, self.length = [], 0
+
+def write_score_header(score, base_name):
+    ''' Writes RTCMix setup and the GRANSYNTH tables used by the tracks '''
+    score.write("set_option(\"clobber = on\")")
+    score.write("rtsetparams(44100, 2)\n")
+    score.write("reset(44100)\n")
+    score.write("load(\"GRANSYNTH\")\n")
+
+    output_string = 'rtoutput(\"' + base_name + '.wav\")\n'
+    score.write(output_string)
+
+    score.write("amp = maketable(\"line\", 1000, 0,0, 1,1, 2,0.5, 3,1, 4,0)\n")
+    score.write("wave = maketable(\"wave\", 2000, 1, 0, 1, 0, 1, 0, 1, 0)\n")
+    score.write("granenv = maketable(\"window\", 2000, \"hanning\")\n")
+    score.write("hoptime = maketable(\"line\", \"nonorm\", 1000, 0,0.01, 1, \
+                                0.002, 2,0.05)\n")
+    score.write("hopjitter = 0.0001\n")
+    score.write("mindur = .04\n")
+    score.write("maxdur = .06\n")
+    score.write("minamp = maxamp = 1\n")
+    score.write("transpcoll = maketable(\"literal\", \"nonorm\", 0, 0, .02,\
+                                .03, .05, .07, .10)\n")
+    score.write("pitchjitter = 1\n")
+
+def sonify(data, score, fps, sample_rate, field, scale, shift, d=None,
+           telemetry=None, region=None, window=None):
+    ''' Sonifies all tracks in dataset. d is the loaded HurricaneDatabase of
+    data, if it has already been loaded. telemetry (a telemetry.Telemetry)
+    times the score writing of each storm. region and window select storms
+    as in animate_tracks.animate (see database_cyclones). '''
     print("Sonifying tracks...")
+    telemetry = NullTelemetry() if telemetry is None else telemetry
     # Load data
+    if d is None:
+        d = HurricaneDatabase()
+        d.load_data(data)
+
+    # Loop through starting timesteps
+    buffer = ScoreBuffer(score)
+    telemetry.start(len(d.list_events()) if region is None and window is None
+                    else len(d.query(region, window)))
+    for k, cyclone in database_cyclones(d, region, window):
+        telemetry.start_step(cyclone.ID)
+        start = float(k)/(sample_rate*fps)
+        cyclone.write_to_cmixscore(buffer, start, fps, sample_rate, scale, shift, field)
+        telemetry.mark('score')
+        telemetry.end_step()
+    buffer.flush()
+    telemetry.finish()
+
+def database_cyclones(d, region=None, window=None):
+    ''' Yields starting timestep and Cyclone of each storm in a loaded
+    database, in order of starting timestep. With region or window only the
+    storms matching d.query(region, window) are yielded; with a window,
+    timesteps count from its first step (so the audio lines up with an
+    animation of the window) and storms starting before it are skipped. '''
+    # Events starting at each timestep
+    starts, ends = d.interval_index()
+    events = d.list_events()
+    selected = None if region is None and window is None else \
+               set(d.query(region, window).tolist())
+    first, stop = d.window_steps(window)
+
+    for k in sorted(starts):
+        if k < first:
+            continue
+        for e in starts[k]:
+            if selected is None or e in selected:
+                yield k - first, Cyclone(d.event_data(events[e]), events[e])
+
+def stream_cyclones(data):
+    ''' Reads storms from the data file one at a time, so memory use does not
+    grow with the dataset. Yields the starting timestep of each storm, computed
+    from its offset to the first storm, and its Cyclone. Storms come in file
+    order (chronological for the model files). '''
     d = HurricaneDatabase()
-    d.load_data(data)
+    t_start, step = None, pd.Timedelta(hours=6)
+
+    for cyclone_ID, df in d.iter_events(data):
+        if len(df.index) == 0:
+            continue
+        if t_start is None:
+            t_start = df.index[0]
+
+        # Storms starting off the 6 hourly grid (or before the first) are skipped
+        k, offset = divmod(df.index[0] - t_start, step)
+        if k < 0 or offset != pd.Timedelta(0):
+            continue
 
-    # Instantiate cyclones and get datetimes
-    objs = [Cyclone(d.event_data(e), e) for e in d.list_events()]
+        yield k, Cyclone(df, cyclone_ID)
 
-    # Get datetimes
-    date_times = d.datetimes()
+def sonify_stream(data, score, fps, sample_rate, field, scale, shift,
+                  buffer_size=2**20, telemetry=None):
+    ''' Sonifies all tracks in dataset, streaming storms from the data file
+    and writing the score in large batches. telemetry (a telemetry.Telemetry)
+    times reading and score writing of each storm. '''
+    print("Sonifying tracks...")
+    telemetry = NullTelemetry() if telemetry is None else telemetry
+    buffer = ScoreBuffer(score, buffer_size)
+    telemetry.start()
+    telemetry.start_step()
+    for k, cyclone in stream_cyclones(data):
+        telemetry.mark('read')
+        start = float(k)/(sample_rate*fps)
+        cyclone.write_to_cmixscore(buffer, start, fps, sample_rate, scale, shift, field)
+        telemetry.mark('score')
+        telemetry.end_step()
+        telemetry.start_step()
+    buffer.flush()
+    telemetry.finish()
+
+def sonify_wav(data, filename, fps, sample_rate, field, scale, shift,
+               synth=None, processes=None, d=None, region=None, window=None):
+    ''' Sonifies all tracks in dataset straight to a WAV file with the NumPy
+    granular synthesizer, instead of writing a score for CMIX. Notes are
+    rendered in parallel across storms. Storms are streamed from the data
+    file unless its loaded HurricaneDatabase d is given (or storms are
+    selected by region or window, see database_cyclones). '''
+    print("Sonifying tracks...")
+    if d is None and (region is not None or window is not None):
+        d = HurricaneDatabase()
+        d.load_data(data)
+    cyclones = stream_cyclones(data) if d is None else \
+               database_cyclones(d, region, window)
+    notes = []
+    for k, cyclone in cyclones:
+        start = float(k)/(sample_rate*fps)
+        notes += cyclone.audio_notes(start, fps, sample_rate, scale, shift, field)
 
-    # Loop through datetimes
-    for k, dt in enumerate(date_times):
-        for obj in objs:
-            if(obj.datetime()[0] == dt):
-                start = float(k)/(sample_rate*fps)
-                obj.write_to_cmixscore(score, start, fps, sample_rate, scale, shift, field)
+    synth = GranularSynth() if synth is None else synth
+    synth.render(notes, filename, processes)
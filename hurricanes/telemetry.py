@@ -0,0 +1,125 @@
+import json
+import time
+import numpy as np
+
+class NullTelemetry():
+    ''' Disabled telemetry. All hooks do nothing, so render loops can call
+    them unconditionally. '''
+    def start(self, total=None):
+        pass
+
+    def start_step(self, label=None):
+        pass
+
+    def mark(self, stage):
+        pass
+
+    def end_step(self, **counters):
+        pass
+
+    def finish(self):
+        pass
+
+class Telemetry(NullTelemetry):
+    ''' Per-step stage timers and counters for render loops (a step is a
+    frame in animate, a storm in sonify). Each step is timed by calling
+    start_step(), then mark(stage) at the end of each stage, which records
+    the time since the previous mark, and end_step(**counters) with e.g. the
+    number of active and fading storms. Every `every` steps a summary with
+    throughput, ETA and per-stage percentiles (in ms) of the steps since the
+    last summary is passed to log (a function taking a line of text, or None)
+    and appended to the JSON-lines file jsonl (path or file object). '''
+    def __init__(self, name, every=100, log=print, jsonl=None,
+                 percentiles=(50, 90, 99)):
+        self.name = name
+        self.every = every
+        self.log = log
+        self.jsonl = jsonl
+        self.percentiles = percentiles
+        self.file = None
+
+    def start(self, total=None):
+        ''' Starts timing a loop of total steps (if known) '''
+        self.total = total
+        self.steps, self.window_steps = 0, 0
+        self.label = None
+        self.counters = {}
+        self.stages = {}
+        self.t_start = self.t_window = self.t_last = time.perf_counter()
+        if isinstance(self.jsonl, str):
+            self.file = open(self.jsonl, 'a')
+        elif self.jsonl is not None:
+            self.file = self.jsonl
+
+    def start_step(self, label=None):
+        ''' Starts timing a step; label (e.g. the date) is reported in summaries '''
+        self.label = label
+        self.t_last = time.perf_counter()
+
+    def mark(self, stage):
+        ''' Ends stage of the current step '''
+        now = time.perf_counter()
+        self.stages.setdefault(stage, []).append(now - self.t_last)
+        self.t_last = now
+
+    def end_step(self, **counters):
+        ''' Ends the current step and records counters '''
+        self.steps += 1
+        self.window_steps += 1
+        self.counters = counters
+        if self.steps % self.every == 0:
+            self.summary()
+
+    def summary(self, final=False):
+        ''' Emits summary of the steps since the last summary '''
+        now = time.perf_counter()
+        elapsed = now - self.t_start
+        rate = self.steps/elapsed if elapsed > 0 else 0.
+
+        record = {'name': self.name, 'steps': self.steps, 'total': self.total,
+                  'label': None if self.label is None else str(self.label),
+                  'elapsed': elapsed, 'rate': rate,
+                  'window_rate': self.window_steps/(now - self.t_window)
+                                 if now > self.t_window else 0.,
+                  'eta': (self.total - self.steps)/rate
+                         if self.total is not None and rate > 0 else None,
+                  'counters': self.counters, 'stages': {}, 'final': final}
+        for stage, times in self.stages.items():
+            ms = 1000.*np.asarray(times)
+            stats = {'mean': float(ms.mean()), 'total': float(ms.sum())/1000.}
+            for p, value in zip(self.percentiles, np.percentile(ms, self.percentiles)):
+                stats['p%d' % p] = float(value)
+            record['stages'][stage] = stats
+
+        if self.log is not None:
+            self.log(self.format(record))
+        if self.file is not None:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+        self.stages, self.window_steps, self.t_window = {}, 0, now
+
+    def format(self, record):
+        ''' Returns one line summary of record '''
+        line = '[{name}] {steps}'.format(**record)
+        if record['total'] is not None:
+            line += '/{total}'.format(**record)
+        if record['label'] is not None:
+            line += ' ({label})'.format(**record)
+        line += ' {rate:.2f}/s'.format(**record)
+        if record['eta'] is not None:
+            line += ' eta {eta:.0f}s'.format(**record)
+        for stage, stats in record['stages'].items():
+            line += ' {stage} {mean:.1f}ms (p{p} {value:.1f}ms)'.format(
+                stage=stage, mean=stats['mean'], p=self.percentiles[-1],
+                value=stats['p%d' % self.percentiles[-1]])
+        for counter, value in record['counters'].items():
+            line += ' {counter}={value}'.format(counter=counter, value=value)
+        return line
+
+    def finish(self):
+        ''' Emits final summary and closes the JSON-lines file if opened here '''
+        self.summary(final=True)
+        if isinstance(self.jsonl, str) and self.file is not None:
+            self.file.close()
+        self.file = None
@@ -0,0 +1,60 @@
+import numpy as np
+from matplotlib.collections import LineCollection
+
+class TrackCollection():
+    ''' Draws the track segments of all cyclones with a single LineCollection.
+    Segment positions, colors and widths are stored in NumPy arrays that are
+    updated in place. Each cyclone reserves a contiguous block of segments when
+    it starts, so tracks are layered in the order cyclones appear. Segments that
+    are not drawn yet (or have been removed) are set to NaN. '''
+    def __init__(self, ax, capacity, linewidth=9.):
+        self.capacity = capacity
+        self.size = 0
+
+        self.segments = np.full((capacity, 2, 2), np.nan)
+        self.colors = np.zeros((capacity, 4))
+        self.linewidths = np.full(capacity, linewidth)
+
+        # Paths share memory with self.segments, so moving a segment only
+        # requires writing to the array
+        self.collection = LineCollection(self.segments, colors=self.colors,
+                                         linewidths=self.linewidths,
+                                         capstyle='projecting',
+                                         joinstyle='round')
+        ax.add_collection(self.collection, autolim=False)
+
+    def add(self, track):
+        ''' Reserves segments for a new track '''
+        n = max(len(track.x) - 1, 0)
+        if self.size + n > self.capacity:
+            raise ValueError("TrackCollection capacity exceeded")
+        track.base = self.size
+        self.size += n
+
+    def set_segments(self, track, start, stop):
+        ''' Draws the segments ending at points start:stop of track '''
+        start = max(start, 1)
+        if start >= stop:
+            return
+
+        k = slice(track.base + start - 1, track.base + stop - 1)
+        self.segments[k, 0, 0] = track.x[start - 1:stop - 1]
+        self.segments[k, 0, 1] = track.y[start - 1:stop - 1]
+        self.segments[k, 1, 0] = track.x[start:stop]
+        self.segments[k, 1, 1] = track.y[start:stop]
+        self.colors[k] = track.colors[start:stop]
+        self.colors[k, 3] = track.alpha
+
+    def set_alpha(self, track, alpha):
+        ''' Sets alpha for all segments of track '''
+        track.alpha = alpha
+        self.colors[track.base:track.base + len(track.x) - 1, 3] = alpha
+
+    def clear(self, track):
+        ''' Removes all segments of track '''
+        self.segments[track.base:track.base + len(track.x) - 1] = np.nan
+
+    def update(self):
+        ''' Pushes colors to the collection before a frame is drawn '''
+        self.collection.set_color(self.colors)
+        self.collection.stale = True